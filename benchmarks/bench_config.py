@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Time taken to read the config and compile the subscriptions at startup,
+   from poca.xml versus from the config snapshot.
+
+   Usage: bench_config.py [--sizes 100 2000] [--rounds 5]"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import stubserver  # noqa, puts poca on the path
+import poca
+
+
+SUB = """    <subscription>
+      <title>Subscription %(no)s</title>
+      <url>http://example.com/feeds/%(no)s.xml</url>
+      <max_number>%(max)s</max_number>%(extra)s
+    </subscription>
+"""
+
+EXTRA = """
+      <rename divider="_"><date/><episode_title/></rename>
+      <metadata><artist>Someone</artist><genre>Podcast</genre></metadata>
+      <filters><weekdays>0246</weekdays></filters>"""
+
+CONFIG = """<poca>
+  <settings>
+    <base_dir>%s</base_dir>
+  </settings>
+  <defaults>
+    <max_number>3</max_number>
+    <track_numbering>if missing</track_numbering>
+  </defaults>
+  <subscriptions>
+%s  </subscriptions>
+</poca>
+"""
+
+
+def write_config(config_dir, number):
+    subs = ''.join(SUB % {'no': no, 'max': no % 5 + 1,
+                          'extra': EXTRA if no % 3 == 0 else ''}
+                   for no in range(number))
+    with open(os.path.join(config_dir, 'poca.xml'), 'w') as f:
+        f.write(CONFIG % (os.path.join(config_dir, 'media'), subs))
+
+
+def startup(args):
+    '''What poca does before any subscription is looked at'''
+    start = time.perf_counter()
+    conf = poca.config.Config(args, merge_default=True)
+    poca.config.subs(conf)
+    return time.perf_counter() - start
+
+
+def measure(number, rounds):
+    config_dir = tempfile.mkdtemp(prefix='poca-bench-')
+    try:
+        write_config(config_dir, number)
+        args = stubserver.quiet_args(config_dir)
+        snapshot = os.path.join(config_dir, 'db', poca.config.SNAPSHOT_FILE)
+        cold, warm = [], []
+        for _ in range(rounds):
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+            cold.append(startup(args))
+            warm.append(startup(args))
+        return min(cold), min(warm)
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 2000])
+    parser.add_argument('--rounds', type=int, default=5)
+    opts = parser.parse_args()
+    print('%-8s %12s %12s %8s' % ('subs', 'poca.xml ms', 'snapshot ms',
+                                  'speedup'))
+    for number in opts.sizes:
+        cold, warm = measure(number, opts.rounds)
+        print('%-8s %12.1f %12.1f %7.1fx' % (number, cold * 1000,
+                                             warm * 1000, cold / warm))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
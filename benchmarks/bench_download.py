@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""CPU time per gigabyte downloaded from a local server: 1 KB chunks from
+   iter_content (as poca did up to 1.1) versus the block writer at
+   various block sizes.
+
+   Usage: bench_download.py [--mb 256] [--blocks 64 256 1024]"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import stubserver
+import poca
+
+
+def legacy_download(entry, settings):
+    '''The 1.1 write loop'''
+    r = poca.connections.session(settings).get(entry['poca_url'],
+                                               stream=True, timeout=60)
+    file_path = os.path.join(entry['directory'], 'legacy.mp3')
+    with open(file_path, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=1024):
+            if chunk:
+                f.write(chunk)
+    r.close()
+
+
+def measure(download, entry, settings, size):
+    '''Returns wall-clock seconds and CPU seconds per GB'''
+    start, cpu = time.perf_counter(), time.process_time()
+    download(entry, settings)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return wall, cpu * 1024 ** 3 / size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mb', type=int, default=256,
+                        help='Size of the test enclosure in megabytes')
+    parser.add_argument('--blocks', nargs='+', type=int,
+                        default=[64, 256, 1024],
+                        help='Block sizes to try in kilobytes')
+    opts = parser.parse_args()
+    size = opts.mb * 1024 ** 2
+    directory = tempfile.mkdtemp(prefix='poca-bench-')
+    settings = deepcopy(poca.config.DEFAULT_XML.settings)
+    print('%-24s %10s %14s' % ('mode', 'seconds', 'cpu s per GB'))
+    try:
+        with stubserver.StubServer(latency=0, items=1, size=size) as server:
+            entry = {'poca_url': server.host + '/media/0/0.mp3',
+                     'names': dict.fromkeys(('permissive', 'ntfs',
+                                             'restrictive', 'fallback'),
+                                            'episode'),
+                     'extension': 'mp3', 'directory': directory,
+                     'unique_filename': True, 'poca_mb': opts.mb}
+            runs = [('iter_content 1 KB', legacy_download, settings)]
+            for block in opts.blocks:
+                block_settings = deepcopy(settings)
+                block_settings.block_size = block
+                runs.append(('block writer %s KB' % block,
+                             poca.files.download_file, block_settings))
+            for name, download, _settings in runs:
+                wall, cpu = measure(download, entry, _settings, size)
+                print('%-24s %10.2f %14.2f' % (name, wall, cpu))
+                sys.stdout.flush()
+                for filename in os.listdir(directory):
+                    os.remove(os.path.join(directory, filename))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
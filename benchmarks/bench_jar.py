@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Size and load time of a subscription history holding full feed entries
+   (as poca did up to 1.1) versus compact episode records, for a feed with
+   long show notes.
+
+   Usage: bench_jar.py [--sizes 100 1000 5000] [--notes 8000]"""
+
+import argparse
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+import feedparser
+from lxml import objectify
+
+import stubserver  # noqa, puts poca on the path
+import poca
+
+
+ITEM = """    <item>
+      <title>Episode %(no)s</title>
+      <guid isPermaLink="false">episode-%(no)s</guid>
+      <pubDate>Mon, %(day)02d Jan 2018 12:00:00 +0000</pubDate>
+      <link>http://example.com/episodes/%(no)s</link>
+      <description><![CDATA[%(notes)s]]></description>
+      <content:encoded><![CDATA[%(notes)s]]></content:encoded>
+      <enclosure url="http://example.com/media/%(no)s.mp3" length="52428800"
+                 type="audio/mpeg"/>
+    </item>
+"""
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">
+  <channel>
+    <title>Bench</title>
+    <link>http://example.com/</link>
+%s  </channel>
+</rss>
+"""
+
+
+def downloaded_entries(number, notes):
+    '''Feed entries as they are when added to the history'''
+    paragraph = '<p>Show notes with <a href="http://example.com/">links</a>' \
+        ' and <em>markup</em>.</p>'
+    html = paragraph * (notes // len(paragraph) + 1)
+    xml = FEED % ''.join(ITEM % {'no': no, 'day': no % 28 + 1, 'notes': html}
+                         for no in range(number))
+    doc = feedparser.parse(xml.encode('utf-8'))
+    sub = poca.subsettings.SubSettings(objectify.fromstring(
+        '<subscription><title>bench</title><url>http://example.com/</url>'
+        '</subscription>'), objectify.Element('defaults'))
+    entries = {}
+    for entry in doc.entries:
+        entry = poca.entryinfo.validate(entry)
+        entry = poca.entryinfo.expand(entry, sub, '/tmp/bench')
+        entry['filename'] = entry['poca_filename']
+        entry['poca_abspath'] = os.path.join('/tmp/bench', entry['filename'])
+        entry['unique_filename'] = True
+        entries[entry.id] = entry
+    return sub, entries
+
+
+def pickled(jar_dic):
+    '''Size and load time of a pickled jar'''
+    data = pickle.dumps({'lst': list(jar_dic), 'dic': jar_dic})
+    start = time.perf_counter()
+    pickle.loads(data)
+    return len(data), time.perf_counter() - start
+
+
+def database(sub, jar_dic):
+    '''Size and load time of the history database'''
+    directory = tempfile.mkdtemp(prefix='poca-bench-')
+    try:
+        history = poca.history.History(os.path.join(directory, 'history'))
+        jar = poca.history.Subjar(history, 'bench', sub.xml_string)
+        jar.save()
+        for index, (uid, entry) in enumerate(jar_dic.items()):
+            jar.add(uid, entry, index)
+        history.conn.close()
+        history = poca.history.History(os.path.join(directory, 'history'))
+        start = time.perf_counter()
+        history.load('bench')
+        seconds = time.perf_counter() - start
+        return os.path.getsize(history.db_filename), seconds
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[100, 1000, 5000])
+    parser.add_argument('--notes', type=int, default=8000,
+                        help='Length of the show notes of each episode')
+    opts = parser.parse_args()
+    print('%-8s %-30s %12s %10s' % ('entries', 'history', 'kB', 'load ms'))
+    for number in opts.sizes:
+        sub, entries = downloaded_entries(number, opts.notes)
+        episodes = {uid: poca.history.Episode.from_entry(entry)
+                    for uid, entry in entries.items()}
+        runs = [('pickle, feed entries', pickled(entries)),
+                ('pickle, episode records', pickled(episodes)),
+                ('sqlite, episode records', database(sub, episodes))]
+        for name, (size, seconds) in runs:
+            print('%-8s %-30s %12.1f %10.1f' % (number, name, size / 1024,
+                                                seconds * 1000))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Download limits at work: bandwidth achieved against rate_kb, the most
+   connections the stub host saw against host_connections and megabytes
+   downloaded against run_mb, for a run of poca with several threads all
+   downloading from the same host.
+
+   Usage: bench_limits.py [--subs 8] [--items 2] [--mb 1] [--threads 4]
+                          [--rate-kb 2048] [--host-connections 2]
+                          [--run-mb 6]"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+import stubserver
+
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+LIMITS = '''<rate_kb>%s</rate_kb>
+    <host_connections>%s</host_connections>
+    <run_mb>%s</run_mb>
+  </settings>'''
+
+
+def downloaded(directory):
+    '''Bytes in media files and partial downloads under directory'''
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names
+               if name.endswith(('.mp3', '.part')))
+
+
+def run(opts, limits):
+    '''Seconds taken, megabytes downloaded and peak connections to the host
+       of a first run with the limits given'''
+    with stubserver.StubServer(latency=0, items=opts.items,
+                               size=opts.mb * 1048576) as server:
+        config_dir = tempfile.mkdtemp(prefix='poca-bench-')
+        try:
+            stubserver.write_config(config_dir, server.host, opts.subs,
+                                    max_number=opts.items)
+            path = os.path.join(config_dir, 'poca.xml')
+            with open(path) as f:
+                xml = f.read()
+            with open(path, 'w') as f:
+                f.write(xml.replace('</settings>', LIMITS % limits))
+            start = time.perf_counter()
+            subprocess.run([sys.executable,
+                            os.path.join(SRC, 'scripts', 'poca'), '-q',
+                            '-t', str(opts.threads), '-c', config_dir],
+                           env=dict(os.environ, PYTHONPATH=SRC),
+                           stdout=subprocess.DEVNULL)
+            wall = time.perf_counter() - start
+            size = downloaded(os.path.join(config_dir, 'media'))
+        finally:
+            shutil.rmtree(config_dir, ignore_errors=True)
+        with urlopen(server.host + '/stats') as r:
+            peak = int(r.read())
+    return wall, size / 1048576, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subs', type=int, default=8)
+    parser.add_argument('--items', type=int, default=2,
+                        help='Episodes per subscription')
+    parser.add_argument('--mb', type=int, default=1,
+                        help='Size of each episode in megabytes')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rate-kb', type=int, default=2048)
+    parser.add_argument('--host-connections', type=int, default=2)
+    parser.add_argument('--run-mb', type=int, default=6)
+    opts = parser.parse_args()
+    print('%-24s %8s %8s %8s %12s' % ('limit', 'seconds', 'MB', 'KB/s',
+                                      'connections'))
+    for name, limits in [
+            ('none', (0, 0, 0)),
+            ('rate_kb %s' % opts.rate_kb, (opts.rate_kb, 0, 0)),
+            ('host_connections %s' % opts.host_connections,
+             (0, opts.host_connections, 0)),
+            ('run_mb %s' % opts.run_mb, (0, 0, opts.run_mb))]:
+        wall, size, peak = run(opts, limits)
+        print('%-24s %8.2f %8.1f %8.0f %12s' % (name, wall, size,
+                                                size * 1024 / wall, peak))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
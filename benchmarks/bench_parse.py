@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Feed parsing throughput, feedparser versus the lxml extractor, and
+   whether the two agree on everything poca reads from a feed. Runs over a
+   generated corpus modelled on common podcast feeds (itunes RSS with long
+   show notes, relative permalink guids, items without guids, Atom, RSS
+   1.0, latin-1) or over a directory of saved feeds.
+
+   Usage: bench_parse.py [--corpus DIR] [--items 200] [--rounds 3]"""
+
+import argparse
+import os
+import sys
+import time
+
+import feedparser
+
+import stubserver  # noqa, puts poca on the path
+import poca
+
+
+NOTES = '<p>Show notes with <a href="http://example.com/">links</a> and ' \
+    '<em>markup</em> &amp; entities.</p>' * 40
+
+ITUNES_ITEM = """    <item>
+      <title>Episode %(no)s: Of &amp; about &lt;things&gt;</title>
+      <guid isPermaLink="false">%(no)s-a8f0c1</guid>
+      <pubDate>Mon, %(day)02d Jan 2018 12:%(min)02d:00 +0100</pubDate>
+      <link>http://example.com/episodes/%(no)s</link>
+      <description><![CDATA[%(notes)s]]></description>
+      <content:encoded><![CDATA[%(notes)s]]></content:encoded>
+      <enclosure url="http://cdn.example.com/media/%(no)s.mp3"
+                 length="52428800" type="audio/mpeg"/>
+      <itunes:duration>01:%(min)02d:13</itunes:duration>
+      <itunes:explicit>no</itunes:explicit>
+    </item>
+"""
+
+ITUNES = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+     xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
+  <channel>
+    <title>Itunes</title>
+    <link>http://example.com/</link>
+    <image><url>http://example.com/small.png</url></image>
+    <itunes:image href="http://example.com/cover.jpg"/>
+%s  </channel>
+</rss>
+"""
+
+PLAIN_ITEM = """    <item>
+      <title><![CDATA[Episode <b>%(no)s</b>]]></title>
+      <guid>episodes/%(no)s</guid>
+      <pubDate>%(day)02d Jan 2018 12:%(min)02d GMT</pubDate>
+      <description>%(short)s</description>
+      <enclosure url="media/%(no)s.ogg" type="audio/ogg"/>
+    </item>
+    <item>
+      <title>Sans guid %(no)s</title>
+      <pubDate>not a date</pubDate>
+      <enclosure url="http://example.com/extra/%(no)s.mp3"/>
+    </item>
+"""
+
+PLAIN = """<?xml version="1.0" encoding="iso-8859-1"?>
+<rss version="2.0">
+  <channel>
+    <title>Pl\xe6in</title>
+%s  </channel>
+</rss>
+"""
+
+ATOM_ENTRY = """  <entry>
+    <title>Entry %(no)s</title>
+    <id>tag:example.com,2018:%(no)s</id>
+    <published>2018-01-%(day)02dT12:%(min)02d:00Z</published>
+    <updated>2018-02-01T00:00:00Z</updated>
+    <link rel="alternate" href="http://example.com/%(no)s"/>
+    <link rel="enclosure" href="/media/%(no)s.m4a" length="1000"
+          type="audio/mp4"/>
+    <content type="html">%(short)s</content>
+  </entry>
+"""
+
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Atom</title>
+  <logo>http://example.com/logo.png</logo>
+%s</feed>
+"""
+
+RDF_ITEM = """  <item rdf:about="http://example.com/rdf/%(no)s">
+    <title>Item %(no)s</title>
+    <dc:date>2018-01-%(day)02d</dc:date>
+    <description>%(short)s</description>
+  </item>
+"""
+
+RDF = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns="http://purl.org/rss/1.0/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <channel rdf:about="http://example.com/rdf"><title>Rdf</title></channel>
+  <image rdf:about="http://example.com/rdf.png">
+    <url>http://example.com/rdf.png</url>
+  </image>
+%s</rdf:RDF>
+"""
+
+KINDS = [('itunes', ITUNES, ITUNES_ITEM, 'utf-8'),
+         ('plain', PLAIN, PLAIN_ITEM, 'iso-8859-1'),
+         ('atom', ATOM, ATOM_ENTRY, 'utf-8'),
+         ('rdf', RDF, RDF_ITEM, 'utf-8')]
+
+
+def generated(number):
+    '''A feed of each kind with number items'''
+    short = NOTES[:300].replace('<', '&lt;')
+    corpus = []
+    for name, feed, item, encoding in KINDS:
+        items = ''.join(item % {'no': no, 'day': no % 28 + 1, 'min': no % 60,
+                                'notes': NOTES, 'short': short}
+                        for no in range(number))
+        corpus.append((name, (feed % items).encode(encoding)))
+    return corpus
+
+
+def from_directory(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'rb') as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def summary(doc):
+    '''Everything poca reads from a parsed feed'''
+    entries = [(entry.get('id'), entry.get('title'),
+                entry.get('published_parsed'), entry.get('itunes_duration'),
+                [(enc.get('href'), enc.get('length'), enc.get('type'))
+                 for enc in entry.get('enclosures', [])])
+               for entry in doc.entries]
+    return entries, doc.feed.get('image', {}).get('href')
+
+
+def measure(parse, body, headers, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        doc = parse(body, headers)
+    return (time.perf_counter() - start) / rounds, doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help='Directory of feeds to parse')
+    parser.add_argument('--items', type=int, default=200,
+                        help='Items per generated feed')
+    parser.add_argument('--rounds', type=int, default=3)
+    opts = parser.parse_args()
+    corpus = from_directory(opts.corpus) if opts.corpus else \
+        generated(opts.items)
+    headers = {'content-location': 'http://example.com/feeds/podcast.xml'}
+    print('%-24s %8s %12s %12s %8s %6s' % ('feed', 'kB', 'feedparser ms',
+                                           'lxml ms', 'speedup', 'same'))
+    totals = [0, 0, 0]
+    for name, body in corpus:
+        slow, doc = measure(lambda b, h: feedparser.parse(
+            b, response_headers=h), body, headers, opts.rounds)
+        fast, lean = measure(poca.feedxml.parse, body, headers, opts.rounds)
+        if lean is None:
+            same = 'n/a'
+            fast = slow
+        else:
+            same = 'yes' if summary(lean) == summary(doc) else 'NO'
+        totals = [totals[0] + len(body), totals[1] + slow, totals[2] + fast]
+        print('%-24s %8.0f %12.1f %12.1f %7.1fx %6s' % (
+            name[:24], len(body) / 1024, slow * 1000, fast * 1000,
+            slow / fast, same))
+        sys.stdout.flush()
+    print('%-24s %8.0f %12.1f %12.1f %7.1fx' % (
+        'total (MB/s)', totals[0] / 1024, totals[0] / totals[1] / 2 ** 20,
+        totals[0] / totals[2] / 2 ** 20, totals[1] / totals[2]))
+
+
+if __name__ == '__main__':
+    main()
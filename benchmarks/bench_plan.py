@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Time spent planning a subscription with a very long feed: combining
+   feed and history, filtering out user deleted episodes, checking for
+   duplicate filenames and working out what to remove and download. List
+   based (as poca did up to 1.1) versus indexed uid lists.
+
+   Usage: bench_plan.py [--sizes 10000 100000] [--legacy-max 10000]"""
+
+import argparse
+import sys
+import time
+
+import feedparser
+from lxml import objectify
+
+import stubserver  # noqa, puts poca on the path
+import poca
+from poca.subupdate import Combo, Wanted
+
+
+class Data:
+    '''A feed of number entries, the newest half of which poca has seen
+       before: a tenth of them deleted by the user, the rest in the jar'''
+    def __init__(self, number):
+        self.sub = poca.subsettings.SubSettings(objectify.fromstring(
+            '<subscription><title>bench</title><url>http://example.com/'
+            '</url></subscription>'), objectify.Element('defaults'))
+        entries = [feedparser.FeedParserDict(
+            id='episode-%s' % no, title='Episode %s' % no,
+            published_parsed=time.gmtime(1500000000 + no * 3600),
+            links=[{'rel': 'enclosure', 'length': '1048576',
+                    'href': 'http://example.com/%s.mp3' % no}])
+            for no in reversed(range(number))]
+        self.feed = type('Feed', (), {})()
+        self.feed.lst = [entry.id for entry in entries]
+        self.feed.dic = {entry.id: entry for entry in entries}
+        self.feed.etag = self.feed.modified = self.feed.image = None
+        self.jar = type('Jar', (), {})()
+        self.jar.lst, self.jar.dic = [], {}
+        self.jar.del_lst = self.feed.lst[:number // 20]
+        for uid in self.feed.lst[number // 20:number // 2]:
+            entry = poca.entryinfo.validate(feedparser.FeedParserDict(
+                self.feed.dic[uid]))
+            entry = poca.entryinfo.expand(entry, self.sub, '/tmp/bench')
+            self.jar.lst.append(uid)
+            self.jar.dic[uid] = entry
+
+
+def legacy_plan(data):
+    '''The 1.1 list operations'''
+    feed, jar, sub = data.feed, data.jar, data.sub
+    lst = list(feed.lst)
+    lst.extend(uid for uid in jar.lst if uid not in feed.lst)
+    dic = {uid: poca.entryinfo.validate(feed.dic[uid]) for uid in feed.lst
+           if uid not in jar.lst}
+    dic.update(jar.dic)
+    wanted = list(filter(lambda x: x not in jar.del_lst, lst))
+    wanted = list(filter(lambda x: dic[x]['valid'], wanted))
+    wanted_dic = {uid: poca.entryinfo.expand(dic[uid], sub, '/tmp/bench')
+                  for uid in wanted}
+    filenames = [wanted_dic[uid]['poca_filename'] for uid in wanted]
+    for uid in wanted:
+        count = filenames.count(wanted_dic[uid]['poca_filename'])
+        wanted_dic[uid]['unique_filename'] = count == 1
+    wanted.reverse()
+    unwanted = [x for x in jar.lst if x not in wanted]
+    lacking = [x for x in wanted if x not in jar.lst]
+    return unwanted, lacking
+
+
+def indexed_plan(data):
+    '''What SubUpdate.plan does once the feed is parsed'''
+    combo = Combo(data.feed, data.jar, data.sub)
+    wanted = Wanted(data.sub, data.feed, combo, data.jar.del_lst,
+                    '/tmp/bench')
+    wanted.lst.reverse()
+    unwanted = poca.uidlist.UidList(data.jar.lst).difference(wanted.lst)
+    lacking = wanted.lst.difference(data.jar.dic)
+    return unwanted, lacking
+
+
+def measure(plan, number):
+    data = Data(number)
+    start = time.perf_counter()
+    unwanted, lacking = plan(data)
+    return time.perf_counter() - start, len(unwanted), len(lacking)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[10000, 100000])
+    parser.add_argument('--legacy-max', type=int, default=10000,
+                        help='Largest feed to plan with lists (quadratic)')
+    opts = parser.parse_args()
+    print('%-8s %-10s %10s %10s %10s' % ('entries', 'mode', 'seconds',
+                                         'unwanted', 'lacking'))
+    for number in opts.sizes:
+        runs = [('indexed', indexed_plan)]
+        if number <= opts.legacy_max:
+            runs.insert(0, ('lists', legacy_plan))
+        for name, plan in runs:
+            seconds, unwanted, lacking = measure(plan, number)
+            print('%-8s %-10s %10.2f %10s %10s' % (number, name, seconds,
+                                                   unwanted, lacking))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
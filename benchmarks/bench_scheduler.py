@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Wall-clock time and peak thread count of a full poca run against local
+   stub feeds: one thread per subscription (as poca did up to 1.1) versus
+   the bounded scheduler.
+
+   Usage: bench_scheduler.py [--sizes 100 1000 10000] [--latency 0.05]"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue
+
+import stubserver
+import poca
+
+
+class PeakThreads(threading.Thread):
+    '''Samples the number of live threads until stopped'''
+    def __init__(self):
+        super(PeakThreads, self).__init__()
+        self.daemon = True
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.005):
+            self.peak = max(self.peak, threading.active_count())
+
+
+def legacy_run(args, conf, subs):
+    '''The 1.1 main loop: a thread per update, polling for upgrades'''
+    fetcher = poca.fetch.Fetcher(conf.xml.settings, limit=len(subs))
+    update_q = Queue()
+    upgrade_threads, skip_subs = [], []
+
+    def update(sub):
+        subdata = poca.subupdate.SubUpdate(conf, sub)
+        if subdata.outcome.success:
+            subdata.plan(fetcher.get(subdata.sub.url))
+        update_q.put(subdata)
+
+    def upgrade(subdata):
+        poca.subupgrade.SubUpgrade(subdata)
+        update_q.task_done()
+
+    for sub in subs:
+        thread = threading.Thread(target=update, args=(sub,))
+        thread.daemon = True
+        thread.start()
+    while len(upgrade_threads) + len(skip_subs) < len(subs):
+        while (len([t for t in upgrade_threads if t.is_alive()])
+               < args.threads and not update_q.empty()):
+            subdata = update_q.get()
+            if subdata.outcome.success is False or subdata.status == 304:
+                skip_subs.append(subdata)
+                update_q.task_done()
+                continue
+            thread = threading.Thread(target=upgrade, args=(subdata,))
+            upgrade_threads.append(thread)
+            thread.start()
+        time.sleep(0.5)
+    for thread in upgrade_threads:
+        thread.join()
+    fetcher.close()
+
+
+def scheduler_run(args, conf, subs):
+    scheduler = poca.scheduler.Scheduler(args, conf, args.feeds,
+                                         args.threads)
+    scheduler.run(subs)
+
+
+def measure(run, host, number):
+    config_dir = tempfile.mkdtemp(prefix='poca-bench-')
+    try:
+        stubserver.write_config(config_dir, host, number)
+        args = stubserver.quiet_args(config_dir)
+        poca.loggers.start_stream_logger(args)
+        poca.loggers.start_after_stream_logger(args)
+        conf = poca.config.Config(args, merge_default=True)
+        subs = poca.config.subs(conf)
+        sampler = PeakThreads()
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            run(args, conf, subs)
+        except RuntimeError as e:
+            return None, sampler.peak, str(e)
+        finally:
+            sampler.stopped.set()
+        return time.perf_counter() - start, sampler.peak, None
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Server response delay in seconds')
+    opts = parser.parse_args()
+    runs = [('thread per feed', legacy_run), ('scheduler', scheduler_run)]
+    print('%-8s %-16s %10s %12s' % ('feeds', 'mode', 'seconds',
+                                    'peak threads'))
+    with stubserver.StubServer(latency=opts.latency) as server:
+        for number in opts.sizes:
+            for name, run in runs:
+                seconds, peak, error = measure(run, server.host, number)
+                seconds = '%10.2f' % seconds if error is None else \
+                    '%10s' % 'failed'
+                print('%-8s %-16s %s %12s' % (number, name, seconds, peak))
+                if error:
+                    print('  (%s)' % error)
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Cold start of poca and poca-subscribe: wall-clock time of a fresh
+   process, time spent importing (as reported by python -X importtime) and
+   which heavy dependencies got imported. The poca run is one in which
+   every feed returns 304, as most cron runs do.
+
+   Usage: bench_startup.py [--subs 20] [--rounds 5] [--src DIR]"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubserver
+
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+HEAVY = ('feedparser', 'requests', 'urllib3', 'mutagen', 'smtplib',
+         'email.mime.text')
+
+
+def run(src, command, rounds):
+    '''Best wall-clock time, import time and heavy modules imported'''
+    env = dict(os.environ, PYTHONPATH=src)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + command,
+                              env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        wall = time.perf_counter() - start
+        if best is None or wall < best[0]:
+            best = (wall, proc.stderr)
+    wall, report = best
+    imported, total = set(), 0
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imported.add(name.strip())
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return wall, total / 1e6, [name for name in HEAVY if name in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subs', type=int, default=20,
+                        help='Number of subscriptions in the poca run')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--src', default=SRC,
+                        help='Directory holding the poca package to time')
+    opts = parser.parse_args()
+    scripts = os.path.join(opts.src, 'scripts')
+    config_dir = tempfile.mkdtemp(prefix='poca-bench-')
+    try:
+        with stubserver.StubServer(latency=0) as server:
+            stubserver.write_config(config_dir, server.host, opts.subs)
+            poca = [os.path.join(scripts, 'poca'), '-q', '-c', config_dir]
+            # the first run downloads everything, the ones timed get 304s
+            subprocess.run([sys.executable] + poca, stdout=subprocess.DEVNULL,
+                           env=dict(os.environ, PYTHONPATH=opts.src))
+            commands = [
+                ('import poca', ['-c', 'import poca']),
+                ('poca-subscribe list',
+                 [os.path.join(scripts, 'poca-subscribe'), '-c', config_dir,
+                  'list']),
+                ('poca, all 304', poca)]
+            print('%-22s %10s %10s  %s' % ('command', 'wall ms', 'import ms',
+                                           'heavy imports'))
+            for name, command in commands:
+                wall, imports, heavy = run(opts.src, command, opts.rounds)
+                print('%-22s %10.0f %10.0f  %s' % (name, wall * 1000,
+                                                   imports * 1000,
+                                                   ', '.join(heavy) or '-'))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
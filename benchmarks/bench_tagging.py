@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Wall-clock time of a poca run that downloads and tags every episode,
+   with tagging done on the download threads versus in a pool of
+   tag_processes, and with or without id3padding. Every subscription sets
+   metadata and numbers its tracks, so that each file is tagged (and,
+   having no tag yet, rewritten unless room was made for the tag while
+   downloading). How much each tagging rewrote is shown by poca -v.
+
+   Usage: bench_tagging.py [--subs 8] [--items 6] [--mb 8] [--threads 4]
+                           [--processes 0 2 4] [--padding no yes]"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubserver
+
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+TAGGING = '''<track_numbering>yes</track_numbering>
+    <metadata><artist>Someone</artist><genre>Podcast</genre></metadata>
+  </defaults>'''
+
+
+def write_config(config_dir, host, subs, items, processes, padding):
+    stubserver.write_config(config_dir, host, subs, max_number=items)
+    path = os.path.join(config_dir, 'poca.xml')
+    with open(path) as f:
+        xml = f.read()
+    xml = xml.replace('</defaults>', TAGGING).replace(
+        '</settings>', '<tag_processes>%s</tag_processes>'
+        '<id3padding>%s</id3padding></settings>' % (processes, padding))
+    with open(path, 'w') as f:
+        f.write(xml)
+
+
+def measure(host, opts, processes, padding):
+    '''Best wall-clock time of a first run (everything to download)'''
+    best = None
+    for _ in range(opts.rounds):
+        config_dir = tempfile.mkdtemp(prefix='poca-bench-')
+        try:
+            write_config(config_dir, host, opts.subs, opts.items, processes,
+                         padding)
+            start = time.perf_counter()
+            subprocess.run([sys.executable,
+                            os.path.join(SRC, 'scripts', 'poca'), '-q',
+                            '-t', str(opts.threads), '-c', config_dir],
+                           env=dict(os.environ, PYTHONPATH=SRC), check=True)
+            wall = time.perf_counter() - start
+        finally:
+            shutil.rmtree(config_dir, ignore_errors=True)
+        best = wall if best is None else min(best, wall)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subs', type=int, default=8)
+    parser.add_argument('--items', type=int, default=6,
+                        help='Episodes per subscription')
+    parser.add_argument('--mb', type=int, default=8,
+                        help='Size of each episode in megabytes')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', nargs='+', type=int,
+                        default=[0, 2, 4])
+    parser.add_argument('--padding', nargs='+', default=['no', 'yes'],
+                        choices=['no', 'yes'])
+    parser.add_argument('--rounds', type=int, default=3)
+    opts = parser.parse_args()
+    size = opts.mb * 1024 ** 2
+    total = opts.subs * opts.items * size
+    print('%-16s %-12s %10s %10s' % ('tag_processes', 'id3padding',
+                                     'seconds', 'MB/s'))
+    with stubserver.StubServer(latency=0, items=opts.items, size=size,
+                               audio=True) as server:
+        for padding in opts.padding:
+            for processes in opts.processes:
+                wall = measure(server.host, opts, processes, padding)
+                print('%-16s %-12s %10.2f %10.1f' % (
+                    processes, padding, wall, total / wall / 2 ** 20))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
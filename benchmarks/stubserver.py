@@ -0,0 +1,160 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Local HTTP server with stub feeds and enclosures for benchmarking.
+   The server runs in a separate process so that its threads do not
+   count towards those of the process being measured."""
+
+import os
+import sys
+import time
+import threading
+from argparse import Namespace
+from multiprocessing import Process, Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+ITEM = """    <item>
+      <title>Episode %(no)s</title>
+      <guid isPermaLink="false">stub-%(feed)s-%(no)s</guid>
+      <pubDate>Mon, %(day)02d Jan 2018 12:00:00 +0000</pubDate>
+      <enclosure url="%(host)s/media/%(feed)s/%(no)s.mp3" length="%(size)s"
+                 type="audio/mpeg"/>
+    </item>
+"""
+
+# a silent MPEG-1 layer III frame (128 kbit/s, 44.1 kHz) for media that can
+# be tagged
+MPEG_FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Stub feed %(feed)s</title>
+    <link>%(host)s/feed/%(feed)s</link>
+%(items)s  </channel>
+</rss>
+"""
+
+
+def stub_feed(host, feed, items, size):
+    '''Returns the xml of a stub feed with items newest first'''
+    entries = [ITEM % {'host': host, 'feed': feed, 'no': no, 'size': size,
+                       'day': no % 28 + 1}
+               for no in reversed(range(items))]
+    return FEED % {'host': host, 'feed': feed, 'items': ''.join(entries)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Serves /feed/<n> as a stub feed and /media/... as zero bytes (or
+       silent mp3 frames). /stats is the most media requests served at
+       the same time so far.'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        etag = None
+        if self.path.startswith('/feed/'):
+            feed = self.path.split('/')[2]
+            etag = '"%s-%s"' % (feed, server.items)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            body = stub_feed(server.host, feed, server.items,
+                             server.size).encode('utf-8')
+            content_type = 'application/rss+xml'
+        elif self.path.startswith('/media/'):
+            with server.lock:
+                server.active += 1
+                server.peak = max(server.peak, server.active)
+            try:
+                self.send_body(server.media, 'audio/mpeg')
+            finally:
+                with server.lock:
+                    server.active -= 1
+            return
+        elif self.path == '/stats':
+            body = str(server.peak).encode('ascii')
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        self.send_body(body, content_type, etag)
+
+    def send_body(self, body, content_type, etag=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port_q, latency, items, size, audio):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.request_queue_size = 4096
+    server.daemon_threads = True
+    server.latency = latency
+    server.items = items
+    server.size = size
+    server.media = (MPEG_FRAME * (size // len(MPEG_FRAME) + 1))[:size] \
+        if audio else bytes(size)
+    server.host = 'http://127.0.0.1:%s' % server.server_address[1]
+    # clients hanging up mid-download (cancelled, out of budget) are fine
+    server.handle_error = lambda request, client_address: None
+    server.lock = threading.Lock()
+    server.active = server.peak = 0
+    port_q.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubServer:
+    '''Context manager running the stub server in a child process'''
+    def __init__(self, latency=0.05, items=3, size=1024, audio=False):
+        self.args = (latency, items, size, audio)
+
+    def __enter__(self):
+        port_q = Queue()
+        self.process = Process(target=serve, args=(port_q,) + self.args)
+        self.process.daemon = True
+        self.process.start()
+        self.host = 'http://127.0.0.1:%s' % port_q.get()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+
+def write_config(config_dir, host, number, max_number=1):
+    '''Writes a poca.xml with number subscriptions to stub feeds'''
+    subs = ''.join('    <subscription><title>stub%s</title>'
+                   '<url>%s/feed/%s</url></subscription>\n' % (i, host, i)
+                   for i in range(number))
+    xml = ('<poca>\n  <settings>\n    <base_dir>%s</base_dir>\n'
+           '  </settings>\n  <defaults>\n    <max_number>%s</max_number>\n'
+           '  </defaults>\n  <subscriptions>\n%s  </subscriptions>\n'
+           '</poca>\n' % (os.path.join(config_dir, 'media'), max_number,
+                          subs))
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, 'poca.xml'), 'w') as f:
+        f.write(xml)
+
+
+def quiet_args(config_dir, threads=4, feeds=8):
+    '''Namespace standing in for the poca command line arguments'''
+    return Namespace(quiet=True, verbose=False, logfile=False, email=False,
+                     config=config_dir, glyphs='default', threads=threads,
+                     feeds=feeds)
@@ -30,6 +30,7 @@ setup(
     requires=['feedparser', 'lxml', 'mutagen', 'requests'],
     install_requires=['feedparser', 'lxml', 'mutagen', 'requests'],
     provides=['poca'],
+    python_requires='>=3.7',
     platforms=['POSIX'],
     keywords=['podcast', 'client', 'aggregator', 'cli'],
     classifiers=['Development Status :: 5 - Production/Stable',
@@ -38,6 +39,6 @@ setup(
                  'License :: OSI Approved :: GNU General Public License (GPL)',
                  'Natural Language :: English',
                  'Operating System :: POSIX',
-                 'Programming Language :: Python :: 3.6',
+                 'Programming Language :: Python :: 3.7',
                  'Topic :: Multimedia :: Sound/Audio']
 )
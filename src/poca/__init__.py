@@ -7,18 +7,23 @@
 
 """poca is the main library of Poca, a command line podcast client"""
 
-from . import about
-from . import args
-from . import outcome
-from . import output
-from . import subupdate
-from . import subupgrade
-from . import config
-from . import entryinfo
-from . import files
-from . import history
-from . import loggers
-from . import subscribe
-from . import xmlconf
-from . import lxmlfuncs
-from . import tag
+import importlib
+
+# submodules are imported when first used, so that poca-subscribe or a run
+# with nothing to download only imports what it needs
+SUBMODULES = ('about', 'args', 'outcome', 'output', 'subupdate',
+              'subupgrade', 'config', 'entryinfo', 'files', 'history',
+              'loggers', 'subscribe', 'xmlconf', 'lxmlfuncs', 'tag',
+              'connections', 'fetch', 'feedcache', 'feedxml', 'workers',
+              'uidlist', 'scheduler', 'subsettings', 'lazy', 'feedstats',
+              'limits')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -34,6 +34,8 @@ def get_poca_args():
     parser.add_argument('-t', '--threads', default=4, type=int,
                         help='Number of concurrent downloads to allow. '
                         '\'--verbose\' forces single thread.')
+    parser.add_argument('-f', '--feeds', default=16, type=int,
+                        help='Number of feeds to fetch concurrently.')
     return parser.parse_args()
 
 
@@ -7,13 +7,18 @@
 
 """A config parser using lxml objectify and XPath"""
 
+import os
+import pickle
+import hashlib
 from os import path
 from lxml import etree, objectify
 from copy import deepcopy
+from collections import Counter
 
-from poca import files, output, xmlconf
+from poca import about, files, output, xmlconf
 from poca.lxmlfuncs import merge
 from poca.outcome import Outcome
+from poca.subsettings import SubSettings
 
 
 E = objectify.ElementMaker(annotate=False)
@@ -27,7 +32,19 @@ DEFAULT_XML = E.poca(
                                 E.id3v2version(4, {'v0': 3, 'v1': 4}),
                                 E.id3removev1('yes', {'v0': 'yes',
                                                       'v1': 'no'}),
+                                E.id3padding('no', {'v0': 'yes',
+                                                    'v1': 'no'}),
                                 E.useragent(''),
+                                E.pool_size(10),
+                                E.block_size(256),
+                                E.segments(1),
+                                E.segment_mb(200),
+                                E.dir_mtime('no', {'v0': 'yes',
+                                                   'v1': 'no'}),
+                                E.tag_processes(0),
+                                E.rate_kb(0),
+                                E.host_connections(0),
+                                E.run_mb(0),
                                 E.email(
                                         E.only_errors('no', {'v0': 'yes',
                                                              'v1': 'no'}),
@@ -43,18 +60,29 @@ DEFAULT_XML = E.poca(
                      )
 
 
+SNAPSHOT_FILE = 'config.pickle'
+# settings that nothing can be downloaded without
+MINIMUMS = {'pool_size': 1, 'block_size': 1}
+
+
 class Config:
-    '''Collection of all configuration options'''
+    '''Collection of all configuration options. The merged config and
+       compiled subscriptions are kept in a snapshot that is used instead
+       of going through poca.xml again for as long as it is unchanged.'''
     def __init__(self, args, merge_default=False):
         self.args = args
         self.paths = Paths(args)
+        self.compiled_subs = None
         if merge_default:
             objectify.deannotate(DEFAULT_XML)
-            self.xml = deepcopy(DEFAULT_XML)
-            user_xml = self.get_xml()
-            errors = merge(user_xml, self.xml, DEFAULT_XML, errors=[])
-            for outcome in errors:
-                output.config_fatal(outcome.msg)
+            self.snapshot_key = self.get_snapshot_key()
+            if not self.load_snapshot():
+                self.xml = deepcopy(DEFAULT_XML)
+                user_xml = self.get_xml()
+                errors = merge(user_xml, self.xml, DEFAULT_XML, errors=[])
+                errors.extend(below_minimum(self.xml.settings))
+                for outcome in errors:
+                    output.config_fatal(outcome.msg)
         else:
             self.xml = self.get_xml()
         base_dir = self.xml.settings.base_dir.text
@@ -74,6 +102,55 @@ class Config:
             msg = 'Could not read %s' % self.paths.config_file
             output.config_fatal(msg)
 
+    def get_snapshot_key(self):
+        '''What the snapshot must have been made from: this version of poca
+           and its defaults, and poca.xml as it is now (mtime, size and
+           hash)'''
+        try:
+            stat = os.stat(self.paths.config_file)
+            with open(self.paths.config_file, 'rb') as f:
+                config_hash = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            return None
+        defaults_hash = hashlib.sha1(etree.tostring(DEFAULT_XML)).hexdigest()
+        return (about.VERSION, defaults_hash, stat.st_mtime_ns, stat.st_size,
+                config_hash)
+
+    def load_snapshot(self):
+        '''Use the snapshot if it was made from the same config. Returns
+           True if it was.'''
+        if self.snapshot_key is None:
+            return False
+        try:
+            with open(self.snapshot_file(), 'rb') as f:
+                key, xml_string, compiled_subs = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, AttributeError,
+                ImportError, TypeError, ValueError):
+            return False
+        if key != self.snapshot_key:
+            return False
+        self.xml = objectify.fromstring(xml_string)
+        self.compiled_subs = compiled_subs
+        return True
+
+    def save_snapshot(self):
+        '''Write the snapshot, replacing the old one atomically'''
+        if self.snapshot_key is None:
+            return
+        snapshot_file = self.snapshot_file()
+        xml_string = etree.tostring(self.xml)
+        try:
+            with open(snapshot_file + '.tmp', 'wb') as f:
+                pickle.dump((self.snapshot_key, xml_string,
+                             self.compiled_subs), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(snapshot_file + '.tmp', snapshot_file)
+        except (OSError, pickle.PickleError):
+            files.delete_file(snapshot_file + '.tmp')
+
+    def snapshot_file(self):
+        return path.join(self.paths.db_dir, SNAPSHOT_FILE)
+
 
 class Paths:
     '''A data-holder object for all program paths'''
@@ -122,13 +199,29 @@ class Paths:
         if not base_dir_outcome.success:
             output.config_fatal(base_dir_outcome.msg)
 
+def below_minimum(settings):
+    '''Errors for the settings set lower than they can go'''
+    return [Outcome(False, '%s: %s. Value must be at least %s' %
+                    (tag, settings[tag], minimum))
+            for tag, minimum in MINIMUMS.items()
+            if int(settings[tag]) < minimum]
+
 def subs(conf):
+    '''The active subscriptions, their settings merged with the defaults
+       and compiled. Taken from the config snapshot if there is one,
+       otherwise a new snapshot is made.'''
+    if conf.compiled_subs is not None:
+        return conf.compiled_subs
     xp_str = './subscription[not(@state="inactive")][title][url]'
     valid_subs = conf.xml.subscriptions.xpath(xp_str)
     valid_subs = [sub for sub in valid_subs if sub.title.text and sub.url.text]
-    sub_names = [sub.title.text for sub in valid_subs]
-    dupes = set([x for x in sub_names if sub_names.count(x) > 1])
+    sub_names = Counter(sub.title.text for sub in valid_subs)
+    dupes = [x for x, count in sub_names.items() if count > 1]
     if len(dupes) > 0:
         msg = "Found the following duplicate titles: %s" % ', '.join(dupes)
         output.config_fatal(msg)
-    return valid_subs
+    conf.compiled_subs = [SubSettings(sub, conf.xml.defaults)
+                          for sub in valid_subs]
+    if hasattr(conf, 'snapshot_key'):
+        conf.save_snapshot()
+    return conf.compiled_subs
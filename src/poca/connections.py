@@ -0,0 +1,91 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Process-wide pool of keep-alive connections for downloads"""
+
+import threading
+from collections import namedtuple
+
+from poca.lazy import LazyModule
+
+# requests is only imported by runs that download something
+requests = LazyModule('requests')
+adapters = LazyModule('requests.adapters')
+connectionpool = LazyModule('urllib3.connectionpool')
+
+
+Stats = namedtuple('Stats', 'requests connections reused')
+
+LOCK = threading.Lock()
+LOCAL = threading.local()
+COUNTS = {'requests': 0, 'connections': 0}
+ADAPTER = []
+# number of hosts to keep pools of idle connections for
+HOSTS = 32
+
+
+def count(key):
+    with LOCK:
+        COUNTS[key] += 1
+
+
+def counting_pool(pool_class):
+    '''A subclass of pool_class keeping track of requests and new
+       connections'''
+    class CountingPool(pool_class):
+        def _new_conn(self):
+            count('connections')
+            return super(CountingPool, self)._new_conn()
+
+        def urlopen(self, *args, **kwargs):
+            count('requests')
+            return super(CountingPool, self).urlopen(*args, **kwargs)
+    return CountingPool
+
+
+def counting_adapter(pool_size):
+    '''An adapter whose pool manager keeps one counting pool per host'''
+    pool_classes = {
+        'http': counting_pool(connectionpool.HTTPConnectionPool),
+        'https': counting_pool(connectionpool.HTTPSConnectionPool)}
+
+    class CountingAdapter(adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super(CountingAdapter, self).init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = pool_classes
+    return CountingAdapter(pool_connections=HOSTS, pool_maxsize=pool_size)
+
+
+def get_adapter(settings):
+    '''Returns the adapter shared by all threads, creating it on first use.
+       pool_size is the number of idle connections kept per host.'''
+    with LOCK:
+        if not ADAPTER:
+            ADAPTER.append(counting_adapter(int(settings.pool_size)))
+        return ADAPTER[0]
+
+
+def session(settings):
+    '''Returns a session for the current thread. Sessions are not shared
+       between threads but they all draw on the same connection pool.'''
+    _session = getattr(LOCAL, 'session', None)
+    if _session is None:
+        _session = requests.Session()
+        adapter = get_adapter(settings)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        if settings.useragent.text:
+            _session.headers['User-Agent'] = settings.useragent.text
+        LOCAL.session = _session
+    return _session
+
+
+def stats():
+    '''Number of requests made, connections opened and connections reused'''
+    with LOCK:
+        _requests, _connections = COUNTS['requests'], COUNTS['connections']
+    return Stats(_requests, _connections, max(_requests - _connections, 0))
@@ -48,12 +48,12 @@ def expand(entry, sub, sub_dir):
     '''expands entry with url, paths and size'''
     if entry['expanded'] is True:
         return entry
-    entry['sub_title'] = sub.title.text
+    entry['sub_title'] = sub.title
     entry['directory'] = sub_dir
     entry['poca_mb'] = info_megabytes(entry)
     #entry['metadata'] = "Coming soon"
     entry['user_vars'] = info_user_vars(entry)
-    entry['rename'] = sub.rename if hasattr(sub, 'rename') else None
+    entry['rename'] = sub.rename
     entry['names'] = names(entry)
     # NOTE: 'poca_filename' used to be the filename to be written to.
     #       Now it just serves as a way to check if multiple entries stand
@@ -101,15 +101,14 @@ def names(entry):
     '''generates a dictionary of file names of decreasing permissiveness'''
     user_vars = entry['user_vars']
     if entry['rename'] is not None:
-        name_children = [el for el in entry['rename'].iterchildren()]
-        name_tags = [el.tag for el in name_children if el.tag in user_vars]
+        name_tags = [tag for tag in entry['rename'].tags if tag in user_vars]
         # note: if a used key is not in user_vars, it is silently discarded
         # so: a user misspelling a key will possibly end up with a zero-length
         # filename. that will result in using the fallback name and be
         # difficult to understand why that happens.
         name_lst = [user_vars[tag] for tag in name_tags]
-        divider = entry['rename'].get('divider') or ' '
-        space = entry['rename'].get('space') or ' '
+        divider = entry['rename'].divider
+        space = entry['rename'].space
         name_base = divider.join(name_lst).replace(' ', space)
     else:
         name_base = user_vars['org_name']
@@ -0,0 +1,63 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Keeping the last version of every feed on disk, so that a change in
+   settings can be planned for without downloading the feed again"""
+
+import os
+import json
+import hashlib
+
+from poca import files
+from poca.fetch import Response
+from poca.outcome import Outcome
+
+
+CACHE_DIR = 'feeds'
+
+
+def cache_file(paths, url):
+    '''The cache file of the feed subscribed to at url'''
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(paths.db_dir, CACHE_DIR, name)
+
+
+def load(paths, url):
+    '''Returns the cached feed as a response or None if there is none.
+       The first line of a cache file holds the url and response headers,
+       the rest is the feed itself.'''
+    try:
+        with open(cache_file(paths, url), 'rb') as f:
+            info = json.loads(f.readline().decode('utf-8'))
+            body = f.read()
+        if info['url'] != url:
+            return None
+        return Response(info['location'], 200, info['headers'], body)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save(paths, url, response):
+    '''Write the feed to the cache, replacing the old version atomically'''
+    cache_path = cache_file(paths, url)
+    outcome = files.check_path(os.path.dirname(cache_path))
+    if not outcome.success:
+        return outcome
+    info = {'url': url, 'location': response.url, 'headers': response.headers}
+    try:
+        with open(cache_path + '.tmp', 'wb') as f:
+            f.write(json.dumps(info).encode('utf-8') + b'\n')
+            f.write(response.body)
+        os.replace(cache_path + '.tmp', cache_path)
+        return Outcome(True, 'Feed cached')
+    except OSError:
+        files.delete_file(cache_path + '.tmp')
+        return Outcome(False, 'Could not cache feed in %s' % cache_path)
+
+
+def delete(paths, url):
+    files.delete_file(cache_file(paths, url))
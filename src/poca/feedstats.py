@@ -10,7 +10,10 @@
 
 import sys
 import time
-import feedparser
+
+from poca.lazy import LazyModule
+
+feedparser = LazyModule('feedparser')
 
 
 EMPTY_ENTRY = {'title': 'n/a', 'published_parsed': None}
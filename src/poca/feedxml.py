@@ -0,0 +1,240 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Reading RSS and Atom feeds with lxml"""
+
+import io
+import urllib.parse
+
+from lxml import etree
+
+from poca.lazy import LazyModule
+
+feedparser = LazyModule('feedparser')
+
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS1 = '{http://purl.org/rss/1.0/}'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+ITUNES = ('{http://www.itunes.com/dtds/podcast-1.0.dtd}',
+          '{http://www.itunes.com/DTDs/Podcast-1.0.dtd}')
+ITEMS = ('item', RSS1 + 'item', ATOM + 'entry')
+# names of elements feedparser reads publication dates from, in any case
+# and namespace
+DATES = ('pubdate', 'published', 'issued')
+
+
+def item_keys(item, base):
+    '''The guid/id and enclosure urls of an item, any of which may be what
+       poca knows it by. Relative ones are also tried resolved against the
+       feed url.'''
+    keys = [item.findtext('guid'), item.get(RDF + 'about'),
+            item.findtext(ATOM + 'id')]
+    keys.extend(enclosure.get('url') for enclosure in item.iter('enclosure'))
+    keys.extend(link.get('href') for link in item.iter(ATOM + 'link')
+                if link.get('rel') == 'enclosure')
+    keys = [key.strip() for key in keys if key]
+    return keys + [urllib.parse.urljoin(base, key) for key in keys]
+
+
+def trim(body, base, known, enough):
+    '''Reads the feed item by item until enough items have been found that
+       are in known and returns the feed without the items that follow.
+       Returns None if the feed cannot be read that way or there is nothing
+       to cut short.'''
+    found = 0
+    parser = etree.iterparse(io.BytesIO(body), events=('end',), tag=ITEMS,
+                             resolve_entities=False, no_network=True,
+                             huge_tree=True)
+    try:
+        for _, item in parser:
+            if any(key in known for key in item_keys(item, base)):
+                found += 1
+                if found == enough:
+                    break
+        else:
+            return None
+    except etree.LxmlError:
+        return None
+    # the parser reads ahead, so drop anything after the last item needed
+    for element in [item] + list(item.iterancestors()):
+        for sibling in list(element.itersiblings()):
+            if sibling.tag in ITEMS:
+                element.getparent().remove(sibling)
+    root = item.getroottree().getroot()
+    return etree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+class Document:
+    '''The parts of a feed that poca uses, laid out like the result of
+       feedparser.parse'''
+    def __init__(self):
+        self.bozo = 0
+        self.feed = feedparser.FeedParserDict()
+        self.entries = []
+
+
+def parse(body, headers):
+    '''Reads guids, titles, publication dates, enclosures and durations of
+       the entries plus the channel image, and nothing else. Returns None
+       for anything out of the ordinary (malformed xml, entities, xml:base,
+       an encoding that disagrees with the http headers, other formats),
+       which is left to feedparser.'''
+    if b'xml:base' in body or b'<!ENTITY' in body:
+        return None
+    parser = etree.XMLParser(resolve_entities=False, no_network=True,
+                             huge_tree=True)
+    try:
+        root = etree.fromstring(body, parser)
+    except (etree.LxmlError, ValueError):
+        return None
+    if not same_encoding(headers, root.getroottree().docinfo.encoding):
+        return None
+    base = headers.get('content-location', '')
+    doc = Document()
+    try:
+        if root.tag == 'rss':
+            channel = root.find('channel')
+            doc.entries = [rss_entry(item, base)
+                           for item in channel.iterfind('item')]
+            set_image(doc, channel, '')
+        elif root.tag == RDF + 'RDF':
+            doc.entries = [rss_entry(item, base, RSS1)
+                           for item in root.iterfind(RSS1 + 'item')]
+            set_image(doc, root.find(RSS1 + 'channel'), RSS1)
+        elif root.tag == ATOM + 'feed':
+            doc.entries = [atom_entry(entry, base)
+                           for entry in root.iterfind(ATOM + 'entry')]
+        else:
+            return None
+    except (AttributeError, ValueError):
+        return None
+    return doc
+
+
+def parse_date(text):
+    '''Dates are read by feedparser's own date parser (in feedparser.datetimes
+       from version 6 on), so they come out as if feedparser had done it'''
+    return getattr(feedparser, 'datetimes', feedparser)._parse_date(text)
+
+
+def same_encoding(headers, encoding):
+    '''Whether the charset in the content-type header, if any, is the one
+       the document was read as'''
+    charset = None
+    for param in headers.get('content-type', '').split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            charset = value.strip().strip('"\'')
+    if not charset:
+        return True
+
+    def norm(name):
+        return name.lower().replace('-', '').replace('_', '')
+    return norm(charset) == norm(encoding or 'utf-8')
+
+
+def text(element):
+    '''All the text in an element, markup in CDATA sections included'''
+    return ''.join(element.itertext()).strip()
+
+
+def rss_entry(item, base, ns=''):
+    '''An RSS item. Permalink guids are resolved against the feed url,
+       enclosure urls are not (feedparser does the same).'''
+    entry = feedparser.FeedParserDict()
+    guid = item.find(ns + 'guid')
+    if guid is not None:
+        uid = text(guid)
+        if not uid:
+            raise ValueError('Empty guid')
+        if (guid.get('isPermaLink') or 'true').lower() != 'false':
+            uid = urllib.parse.urljoin(base, uid)
+        entry['id'] = uid
+    elif item.get(RDF + 'about'):
+        entry['id'] = item.get(RDF + 'about').strip()
+    title = item.find(ns + 'title')
+    if title is not None:
+        entry['title'] = text(title)
+    set_published(entry, item, ns + 'pubDate')
+    links = []
+    for enclosure in item.iterfind(ns + 'enclosure'):
+        if not enclosure.get('url'):
+            raise ValueError('Enclosure without url')
+        links.append(link(enclosure, enclosure.get('url').strip()))
+    if links:
+        entry['links'] = links
+    set_duration(entry, item)
+    return entry
+
+
+def atom_entry(element, base):
+    '''An Atom entry. Ids and enclosure links are resolved against the feed
+       url.'''
+    entry = feedparser.FeedParserDict()
+    uid = element.find(ATOM + 'id')
+    if uid is not None:
+        entry['id'] = urllib.parse.urljoin(base, text(uid))
+    title = element.find(ATOM + 'title')
+    if title is not None:
+        if title.get('type') not in (None, 'text'):
+            raise ValueError('Markup in title')
+        entry['title'] = text(title)
+    set_published(entry, element, ATOM + 'published')
+    links = []
+    for enclosure in element.iterfind(ATOM + 'link'):
+        if enclosure.get('rel') != 'enclosure':
+            continue
+        if not enclosure.get('href'):
+            raise ValueError('Enclosure without href')
+        href = urllib.parse.urljoin(base, enclosure.get('href').strip())
+        links.append(link(enclosure, href))
+    if links:
+        entry['links'] = links
+    set_duration(entry, element)
+    return entry
+
+
+def set_published(entry, item, tag):
+    '''The publication date, from the element tag. feedparser takes it
+       from others as well (dcterms:issued, pubdate in other cases etc.),
+       the last one winning, so items with any of those are left to it.'''
+    dates = [child for child in item if isinstance(child.tag, str) and
+             etree.QName(child).localname.lower() in DATES]
+    if not dates:
+        return
+    if len(dates) > 1 or dates[0].tag != tag:
+        raise ValueError('Date left to feedparser')
+    entry['published_parsed'] = parse_date(text(dates[0]))
+
+
+def link(enclosure, href):
+    '''An enclosure as feedparser lists it among the links of an entry'''
+    attrs = feedparser.FeedParserDict(rel='enclosure', href=href)
+    for key in ('length', 'type'):
+        if enclosure.get(key) is not None:
+            attrs[key] = enclosure.get(key)
+    return attrs
+
+
+def set_duration(entry, item):
+    for ns in ITUNES:
+        duration = item.find(ns + 'duration')
+        if duration is not None:
+            entry['itunes_duration'] = text(duration)
+
+
+def set_image(doc, channel, ns):
+    '''The channel image: the last of any image url or itunes image'''
+    href = None
+    for child in channel:
+        if child.tag == ns + 'image':
+            href = child.findtext(ns + 'url', href)
+        elif child.tag in (itunes + 'image' for itunes in ITUNES):
+            href = child.get('href', href)
+    if href is not None:
+        doc.feed['image'] = feedparser.FeedParserDict(href=href.strip())
@@ -0,0 +1,381 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Fetching raw feeds concurrently on an asyncio event loop"""
+
+import os
+import ssl
+import zlib
+import base64
+import asyncio
+import urllib.parse
+from collections import defaultdict
+from threading import Thread
+
+from poca import about
+from poca.lazy import LazyModule
+
+# only needed for feeds fetched through a proxy or read from a file
+client = LazyModule('http.client')
+request = LazyModule('urllib.request')
+
+
+REDIRECTS = (301, 302, 303, 307, 308)
+PERMANENT = (301, 308)
+MAX_REDIRECTS = 5
+# bytes of a body read at a time, each read getting timeout seconds
+BLOCK = 65536
+SAFE_CHARS = "/?#[]@!$&'()*+,;=:%~"
+ACCEPT = ('application/atom+xml,application/rdf+xml,application/rss+xml,'
+          'application/x-netcdf,application/xml;q=0.9,text/xml;q=0.2,'
+          '*/*;q=0.1')
+USERAGENT = 'poca/%s +%s' % (about.VERSION, about.URL)
+
+
+class Response:
+    '''The raw result of fetching a feed. On network failure status is 0
+       and error says what went wrong. href is where the feed should be
+       fetched from in the future.'''
+    def __init__(self, url, status=0, headers=None, body=b'', error=''):
+        self.url = url
+        self.href = url
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.error = error
+
+    @property
+    def etag(self):
+        return self.headers.get('etag')
+
+    @property
+    def modified(self):
+        return self.headers.get('last-modified')
+
+
+class HTTPError(Exception):
+    '''Malformed or unsupported response from server'''
+
+
+class Connection:
+    '''An open, possibly reusable connection to a single host'''
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class Fetcher:
+    '''Runs an event loop in a background thread and fetches feeds on it,
+       keeping idle connections open for reuse. At most limit requests are
+       in flight at any time and at most per_host to the same host. Feeds
+       that the http(s)_proxy environment variables send through a proxy
+       are fetched with urllib on a thread of the loop instead, and feeds
+       given as a local path or file url are read there.'''
+    def __init__(self, settings, limit=16, per_host=4, timeout=30):
+        self.useragent = settings.useragent.text or USERAGENT
+        self.limit = limit
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = defaultdict(list)
+        self.host_slots = {}
+        self.ssl_context = ssl.create_default_context()
+        # urllib is not imported unless a proxy may be needed
+        self.proxies = request.getproxies() if any(
+            key.lower().endswith('_proxy') for key in os.environ) else {}
+        self.opener = None
+        self.loop = asyncio.new_event_loop()
+        self.slots = None
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, url, etag=None, modified=None, callback=None):
+        '''Schedule a fetch from any thread. Returns a future; the callback,
+           if any, is called with the response on the loop thread and
+           should therefore not block.'''
+        coro = self.fetch(url, etag, modified)
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(f.result()))
+        return future
+
+    def get(self, url, etag=None, modified=None):
+        '''Blocking fetch for use outside the event loop'''
+        return self.submit(url, etag, modified).result()
+
+    def close(self):
+        '''Close idle connections and stop the loop'''
+        def stop():
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(stop)
+        self.thread.join()
+
+    async def fetch(self, url, etag=None, modified=None):
+        '''Conditional GET of url, following redirects. A chain of
+           permanent redirects from the start is reported as 301 with
+           the url it led to, as feedparser did.'''
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.limit)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        original, moved_to, permanent = url, url, True
+        async with self.slots:
+            for _ in range(MAX_REDIRECTS + 1):
+                try:
+                    response = await self.request(url, headers)
+                except (OSError, EOFError, asyncio.TimeoutError, HTTPError,
+                        zlib.error, ValueError) as e:
+                    msg = 'timed out' if isinstance(e, asyncio.TimeoutError) \
+                        else str(e) or e.__class__.__name__
+                    return Response(url, error='Could not fetch %s: %s'
+                                    % (url, msg))
+                location = response.headers.get('location')
+                if response.status not in REDIRECTS or not location:
+                    break
+                url = urllib.parse.urljoin(url, location)
+                permanent = permanent and response.status in PERMANENT
+                if permanent:
+                    moved_to = url
+            else:
+                return Response(url, error='Too many redirects from %s'
+                                % moved_to)
+        if not 200 <= response.status < 300 and response.status != 304:
+            response.error = 'Fetching %s failed with HTTP status %s' % \
+                (url, response.status)
+        elif response.status == 200 and moved_to != original:
+            response.status = 301
+            response.href = moved_to
+        return response
+
+    async def request(self, url, headers):
+        '''A single GET request on a pooled connection'''
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme in ('', 'file'):
+            return await self.loop.run_in_executor(
+                None, self.read_file, url, parsed)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError('Unsupported url')
+        headers = dict(headers, **authorization(parsed))
+        if parsed.scheme in self.proxies and \
+                not request.proxy_bypass(parsed.hostname):
+            return await self.loop.run_in_executor(
+                None, self.request_by_proxy, parsed, headers)
+        tls = parsed.scheme == 'https'
+        port = parsed.port or (443 if tls else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        target = parsed.path or '/'
+        if parsed.query:
+            target = target + '?' + parsed.query
+        target = urllib.parse.quote(target, safe=SAFE_CHARS)
+        host = parsed.hostname if parsed.port is None else \
+            '%s:%s' % (parsed.hostname, parsed.port)
+        lines = ['GET %s HTTP/1.1' % target,
+                 'Host: %s' % host,
+                 'User-Agent: %s' % self.useragent,
+                 'Accept: %s' % ACCEPT,
+                 'Accept-Encoding: gzip, deflate',
+                 'Connection: keep-alive']
+        lines.extend('%s: %s' % item for item in headers.items())
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if key not in self.host_slots:
+            self.host_slots[key] = asyncio.Semaphore(self.per_host)
+        async with self.host_slots[key]:
+            conn, reused = await self.connect(key, tls)
+            try:
+                status, resp_headers, body = await self.exchange(conn, head)
+            except (OSError, EOFError, HTTPError):
+                conn.close()
+                if not reused:
+                    raise
+                # the server may have dropped an idle connection, retry once
+                conn, reused = await self.connect(key, tls, fresh=True)
+                try:
+                    status, resp_headers, body = \
+                        await self.exchange(conn, head)
+                except BaseException:
+                    conn.close()
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+            if conn.reusable:
+                self.idle[key].append(conn)
+            else:
+                conn.close()
+        return Response(url, status, resp_headers, decode(body, resp_headers))
+
+    def request_by_proxy(self, parsed, headers):
+        '''A single GET through the proxy, blocking. Redirects are not
+           followed, as with request.'''
+        if self.opener is None:
+            # without a redirect handler redirects come back as HTTPError
+            self.opener = request.OpenerDirector()
+            for handler in (request.ProxyHandler(self.proxies),
+                            request.UnknownHandler(), request.HTTPHandler(),
+                            request.HTTPSHandler(context=self.ssl_context),
+                            request.HTTPDefaultErrorHandler(),
+                            request.HTTPErrorProcessor()):
+                self.opener.add_handler(handler)
+        # user info goes in the Authorization header, not the url
+        netloc = parsed.netloc.rpartition('@')[2]
+        url = urllib.parse.urlunsplit(parsed._replace(netloc=netloc))
+        req = request.Request(url, headers=dict(
+            headers, **{'User-Agent': self.useragent, 'Accept': ACCEPT,
+                        'Accept-Encoding': 'gzip, deflate'}))
+        try:
+            with self.opener.open(req, timeout=self.timeout) as r:
+                status, resp_headers, body = r.status, r.headers, r.read()
+        except request.HTTPError as e:
+            status, resp_headers, body = e.code, e.headers, e.read()
+        except client.HTTPException as e:
+            raise HTTPError(str(e) or e.__class__.__name__)
+        headers = {}
+        for name, value in resp_headers.items():
+            name = name.lower()
+            headers[name] = headers[name] + ', ' + value \
+                if name in headers else value
+        return Response(parsed.geturl(), status, headers,
+                        decode(body, headers))
+
+    @staticmethod
+    def read_file(url, parsed):
+        '''A feed on the local filesystem, read as if served with a 200,
+           as feedparser would'''
+        path = request.url2pathname(parsed.path) if parsed.scheme else url
+        with open(path, 'rb') as f:
+            return Response(url, 200, {}, f.read())
+
+    async def connect(self, key, tls, fresh=False):
+        '''Returns an idle connection to the host if there is one'''
+        while self.idle[key] and not fresh:
+            conn = self.idle[key].pop()
+            if not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        scheme, hostname, port = key
+        coro = asyncio.open_connection(
+            hostname, port, ssl=self.ssl_context if tls else None,
+            server_hostname=hostname if tls else None)
+        reader, writer = await asyncio.wait_for(coro, self.timeout)
+        return Connection(key, reader, writer), False
+
+    async def exchange(self, conn, head):
+        '''Send the request and read status, headers and body'''
+        conn.writer.write(head)
+        await asyncio.wait_for(conn.writer.drain(), self.timeout)
+        status_line = await self.readline(conn)
+        try:
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise HTTPError('Bad status line')
+        headers = {}
+        while True:
+            line = await self.readline(conn)
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name in headers and name != 'set-cookie':
+                value = headers[name] + ', ' + value
+            headers[name] = value
+        if version != 'HTTP/1.1' or \
+                headers.get('connection', '').lower() == 'close':
+            conn.reusable = False
+        if status in (204, 304) or 100 <= status < 200:
+            return status, headers, b''
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self.read_chunked(conn)
+        elif 'content-length' in headers:
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise HTTPError('Bad Content-Length')
+            body = await self.read_exactly(conn, length)
+        else:
+            conn.reusable = False
+            body = await self.read_to_eof(conn)
+        return status, headers, body
+
+    async def read_chunked(self, conn):
+        chunks = []
+        while True:
+            size_line = await self.readline(conn)
+            try:
+                size = int(size_line.split(';')[0], 16)
+            except ValueError:
+                raise HTTPError('Bad chunk size')
+            if size == 0:
+                while await self.readline(conn):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.read_exactly(conn, size))
+            await self.readline(conn)
+
+    async def readline(self, conn):
+        line = await self.read(conn.reader.readline())
+        if not line.endswith(b'\n'):
+            raise HTTPError('Connection closed by server')
+        return line.decode('latin-1').rstrip('\r\n')
+
+    async def read(self, coro):
+        '''Any read stalling for longer than timeout fails the fetch'''
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def read_exactly(self, conn, length):
+        '''Read length bytes a block at a time, so that a large feed
+           arriving slowly but steadily does not time out'''
+        body = bytearray()
+        while len(body) < length:
+            body += await self.read(conn.reader.readexactly(
+                min(length - len(body), BLOCK)))
+        return bytes(body)
+
+    async def read_to_eof(self, conn):
+        body = bytearray()
+        while True:
+            block = await self.read(conn.reader.read(BLOCK))
+            if not block:
+                return bytes(body)
+            body += block
+
+
+def authorization(parsed):
+    '''Basic authorization header for the user info of a url, if any'''
+    if parsed.username is None:
+        return {}
+    credentials = '%s:%s' % (urllib.parse.unquote(parsed.username),
+                             urllib.parse.unquote(parsed.password or ''))
+    token = base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return {'Authorization': 'Basic ' + token}
+
+
+def decode(body, headers):
+    '''Undo gzip/deflate content encoding'''
+    encoding = headers.get('content-encoding', '').lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
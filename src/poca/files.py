@@ -8,73 +8,556 @@
 """File operations"""
 
 import os
+import json
+import errno
 import shutil
-import requests
 
-from threading import current_thread
+from contextlib import contextmanager
+from threading import Lock, current_thread
 
+from poca import limits, tag
+from poca.lazy import LazyModule
 from poca.outcome import Outcome
+from poca.workers import WorkerPool
 
+# only needed for downloading
+urllib3 = LazyModule('urllib3')
+requests = LazyModule('requests')
+connections = LazyModule('poca.connections')
 
-def download_file(entry, settings):
-    '''Download function with block time outs'''
+
+BUDGET_MSG = 'Download of %s stopped, the byte budget of this run is used up'
+# bytes downloaded between recording how far a download has got
+PROGRESS_BYTES = 8 * 1048576
+
+
+def download_file(entry, settings, padding=0, limiter=None):
+    '''Download function with block time outs. The file is written to a
+       .part file and only renamed into place once complete. A .part left
+       by an interrupted download is resumed if the server allows it.
+       padding is the number of bytes of ID3 frames to make room for in
+       an mp3 downloaded as a single stream, so that it can be tagged
+       without being rewritten. The download keeps to the bandwidth,
+       connection and byte limits of limiter (by default those of the
+       settings).'''
     my_thread = current_thread()
-    headers = requests.utils.default_headers()
     url = entry['poca_url']
-    if settings.useragent.text:
-        useragent = {'User-Agent': settings.useragent.text}
-        headers.update(useragent)
     if getattr(my_thread, "kill", False):
         return Outcome(None, 'Download cancelled by user')
+    limiter = limiter or limits.Limiter(settings)
+    if limiter.spent():
+        return Outcome(False, BUDGET_MSG % url)
+    staged = stage_file(entry, settings)
+    if staged is None:
+        # this should really never happen
+        return Outcome(False, 'Somehow none of the filenames we tried worked')
+    filename, file_path, part = staged
+    outcome = download_segmented(entry, part, settings, my_thread, limiter)
+    if outcome is not None:
+        if outcome.success:
+            part.finish(file_path)
+            return Outcome(True, (filename, file_path))
+        return outcome
+    if not limiter.connect(url, my_thread):
+        return Outcome(None, 'Download cancelled by user')
     try:
-        r = requests.get(url, stream=True, timeout=60, headers=headers)
-    except (requests.exceptions.ConnectionError,
-            requests.exceptions.HTTPError) as e:
+        return download_stream(url, filename, file_path, part, settings,
+                               my_thread, padding, limiter)
+    finally:
+        limiter.disconnect(url)
+
+
+def download_stream(url, filename, file_path, part, settings, my_thread,
+                    padding, limiter):
+    '''Download the file (or the rest of it) as a single stream'''
+    session = connections.session(settings)
+    for attempt in range(2):
+        try:
+            r = session.get(url, stream=True, timeout=60,
+                            headers=part.headers())
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError) as e:
+            return Outcome(False, 'Download of %s failed' % url)
+        except requests.exceptions.Timeout:
+            return Outcome(False, 'Download of %s timed out' % url)
+        if part.offset and not part.accepts(r):
+            # range not satisfiable (or not as asked), start over
+            r.close()
+            part.discard()
+            continue
+        break
+    if r.status_code >= 400:
+        r.close()
         return Outcome(False, 'Download of %s failed' % url)
+    try:
+        with part.open(r) as f:
+            # the size the file should come to, if there is telling
+            length = body_length(r)
+            expected = None if length is None else f.tell() + length
+            if padding and not part.offset:
+                pad_id3(r, f, part, padding, settings)
+                if expected is not None:
+                    expected += part.shift
+            reserve(f, expected)
+            try:
+                complete = write_stream(r, f, settings, my_thread,
+                                        limiter=limiter, part=part)
+            finally:
+                # give back space reserved but not written to
+                f.truncate()
+                part.checkpoint(f)
+            size = f.tell()
+        r.close()
+        if not complete:
+            return Outcome(None, 'Download cancelled by user')
+        if expected is not None and size != expected:
+            # connection closed early without an error, keep the part
+            return Outcome(False, 'Download of %s broke off' % url)
+        part.finish(file_path)
+        return Outcome(True, (filename, file_path))
+    except limits.BudgetSpent:
+        r.close()
+        return Outcome(False, BUDGET_MSG % url)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+        r.close()
+        return Outcome(False, 'Download of %s broke off' % url)
     except requests.exceptions.Timeout:
+        r.close()
         return Outcome(False, 'Download of %s timed out' % url)
-    if r.status_code >= 400:
-        return Outcome(False, 'Download of %s failed' % url)
+    except OSError:
+        r.close()
+        return Outcome(False, 'Could not write %s' % file_path)
+
+
+def filenames(entry, settings):
+    '''Candidate filenames in order of decreasing permissiveness'''
     filename_keys = ['permissive', 'ntfs', 'restrictive', 'fallback']
     start_at = settings.filenames.text or 'permissive'
     if start_at in filename_keys:
         filename_keys = filename_keys[filename_keys.index(start_at):]
     if not entry['unique_filename']:
         filename_keys = ['fallback']
-    for key in filename_keys:
-        filename = '.'.join((entry['names'][key], entry['extension']))
-        file_path = os.path.join(entry['directory'], filename)
+    return ['.'.join((entry['names'][key], entry['extension']))
+            for key in filename_keys]
+
+
+def download_segmented(entry, part, settings, my_thread, limiter):
+    '''Downloads a large enclosure as several byte ranges in parallel, if
+       enabled and the server supports it. Returns None if the file should
+       be downloaded as a single stream instead.'''
+    url = entry['poca_url']
+    if not part.segments:
+        number = int(settings.segments)
+        threshold = float(settings.segment_mb) * 1048576
+        if number < 2 or part.offset:
+            return None
+        if entry['poca_mb'] and entry['poca_mb'] * 1048576 < threshold:
+            return None
+        session = connections.session(settings)
+        try:
+            h = session.head(url, allow_redirects=True, timeout=60)
+            h.close()
+            size = int(h.headers.get('content-length', 0))
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+        validator = strong_validator(h.headers)
+        accept_ranges = h.headers.get('accept-ranges', '').lower()
+        if h.status_code != 200 or 'bytes' not in accept_ranges or \
+                h.headers.get('content-encoding') or not validator or \
+                size < threshold:
+            return None
+        try:
+            part.split(size, number, validator)
+        except OSError:
+            return Outcome(False, 'Could not write %s' % part.path)
+    pool = WorkerPool(len(part.segments), maxsize=0)
+    jobs = [pool.submit(download_segment, url, part, segment, settings,
+                        my_thread, limiter)
+            for segment in part.segments if segment.pos <= segment.end]
+    outcomes = [job.wait() for job in jobs]
+    pool.shutdown()
+    errors = [job.error for job in jobs if job.error is not None]
+    if any(isinstance(error, RangeError) for error in errors):
+        # file has changed or ranges are not honoured after all
+        part.discard()
+        return None
+    if errors:
+        raise errors[0]
+    part.save()
+    for outcome in outcomes:
+        if outcome.success is not True:
+            return outcome
+    return Outcome(True, 'All segments downloaded')
+
+
+class RangeError(Exception):
+    '''Server did not return the byte range asked for'''
+
+
+def download_segment(url, part, segment, settings, my_thread, limiter):
+    '''Downloads the remainder of a single segment into the part file, on
+       a connection of its own'''
+    if not limiter.connect(url, my_thread):
+        return Outcome(None, 'Download cancelled by user')
+    try:
+        return download_range(url, part, segment, settings, my_thread,
+                              limiter)
+    finally:
+        limiter.disconnect(url)
+
+
+def download_range(url, part, segment, settings, my_thread, limiter):
+    '''Request the segment and write it to the part file'''
+    session = connections.session(settings)
+    headers = {'Range': 'bytes=%s-%s' % (segment.pos, segment.end),
+               'If-Range': part.validator}
+    try:
+        r = session.get(url, stream=True, timeout=60, headers=headers)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.HTTPError) as e:
+        return Outcome(False, 'Download of %s failed' % url)
+    except requests.exceptions.Timeout:
+        return Outcome(False, 'Download of %s timed out' % url)
+    if r.status_code != 206 or range_start(r) != segment.pos:
+        r.close()
+        raise RangeError(url)
+    try:
+        with open(part.path, 'r+b') as f:
+            f.seek(segment.pos)
+            try:
+                complete = write_stream(r, f, settings, my_thread, segment,
+                                        limiter, part)
+            finally:
+                part.checkpoint(f, segment)
+        r.close()
+        if not complete:
+            return Outcome(None, 'Download cancelled by user')
+        if segment.pos <= segment.end:
+            return Outcome(False, 'Download of %s broke off' % url)
+        return Outcome(True, 'Segment downloaded')
+    except limits.BudgetSpent:
+        r.close()
+        return Outcome(False, BUDGET_MSG % url)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+        r.close()
+        return Outcome(False, 'Download of %s broke off' % url)
+    except requests.exceptions.Timeout:
+        r.close()
+        return Outcome(False, 'Download of %s timed out' % url)
+    except OSError:
+        r.close()
+        return Outcome(False, 'Could not write %s' % part.path)
+
+
+def write_stream(r, f, settings, my_thread, segment=None, limiter=None,
+                 part=None):
+    '''Copy the response body to f in blocks of block_size kilobytes,
+       reading into the same buffer each time. Every PROGRESS_BYTES the
+       progress is recorded in part (if any). Returns False if the
+       download was cancelled. Raises BudgetSpent if the byte budget of
+       limiter runs out before the end.'''
+    block = bytearray(int(settings.block_size) * 1024)
+    view = memoryview(block)
+    raw = r.raw
+    raw.decode_content = True
+    unrecorded = 0
+    with stream_errors():
+        while True:
+            if getattr(my_thread, "kill", False):
+                return False
+            if limiter is not None:
+                limiter.check()
+            size = raw.readinto(block)
+            if not size:
+                return True
+            f.write(view[:size])
+            if segment is not None:
+                segment.pos += size
+            if part is not None:
+                unrecorded += size
+                if unrecorded >= PROGRESS_BYTES:
+                    part.checkpoint(f, segment)
+                    unrecorded = 0
+            if limiter is not None:
+                limiter.passed(size, my_thread)
+
+
+def pad_id3(r, f, part, padding, settings):
+    '''Write the ID3 tag at the start of the download with room for
+       padding more bytes of frames (see tag.padded_head). The bytes added
+       are kept in the part info so that a resumed download asks for the
+       right range.'''
+    raw = r.raw
+    raw.decode_content = True
+
+    def read(size):
+        data = b''
+        while len(data) < size:
+            chunk = raw.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+    length = body_length(r) or 0
+    with stream_errors():
+        head, part.shift = tag.padded_head(read, padding,
+                                           int(settings.id3v2version),
+                                           length)
+    part.save()
+    f.write(head)
+
+
+@contextmanager
+def stream_errors():
+    '''Raise the errors of reading a response body the way requests
+       does'''
+    try:
+        yield
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except urllib3.exceptions.SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+
+def reserve(f, size):
+    '''Allocate disk space for the rest of the file up front, if the size
+       it will come to is known, to avoid fragmentation and fail early on a
+       full disk'''
+    if hasattr(os, 'posix_fallocate') and size and size > f.tell():
+        allocate(f, f.tell(), size - f.tell())
+
+
+def allocate(f, offset, length):
+    try:
+        os.posix_fallocate(f.fileno(), offset, length)
+    except OSError as e:
+        # not supported by the filesystem is fine, out of space is not
+        if e.errno == errno.ENOSPC:
+            raise
+
+
+def body_length(r):
+    '''Bytes the response body should come to: its Content-Length, or the
+       size of the range of a 206 without one. None if there is no telling
+       or the body is encoded (and so decoded to some other length).'''
+    if r.headers.get('content-encoding', 'identity') != 'identity':
+        return None
+    try:
+        return int(r.headers['content-length'])
+    except (KeyError, ValueError):
+        pass
+    if r.status_code != 206:
+        return None
+    content_range = r.headers.get('content-range', '')
+    first, _, last = content_range.replace('bytes', '').strip() \
+        .partition('/')[0].partition('-')
+    try:
+        return int(last) - int(first) + 1
+    except ValueError:
+        return None
+
+
+def range_start(r):
+    '''First byte of a 206 response according to its Content-Range'''
+    content_range = r.headers.get('content-range', '')
+    start = content_range.replace('bytes', '').strip().split('-')[0]
+    try:
+        return int(start)
+    except ValueError:
+        return None
+
+
+def strong_validator(headers):
+    '''ETag unless weak, else Last-Modified (If-Range needs strong)'''
+    etag = headers.get('etag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def stage_file(entry, settings):
+    '''Returns filename, path and staging file for the first candidate
+       filename the filesystem accepts, preferring one with a partial
+       download already in place'''
+    candidates = [(filename, os.path.join(entry['directory'], filename))
+                  for filename in filenames(entry, settings)]
+    for filename, file_path in candidates:
+        part = PartFile(file_path, entry['poca_url'])
+        if part.offset or part.segments:
+            return filename, file_path, part
+    for filename, file_path in candidates:
+        part = PartFile(file_path, entry['poca_url'])
         try:
-            with open(file_path, 'wb') as f:
-                try:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if getattr(my_thread, "kill", False):
-                            r.close()
-                            _outcome = delete_file(f.name)
-                            return Outcome(None, 'Download cancelled by user')
-                        if chunk:
-                            f.write(chunk)
-                    r.close()
-                    return Outcome(True, (filename, file_path))
-                except requests.exceptions.ConnectionError as e:
-                    r.close()
-                    _outcome = delete_file(f.name)
-                    return Outcome(False, 'Download of %s broke off' % url)
-                except requests.exceptions.Timeout:
-                    r.close()
-                    _outcome = delete_file(f.name)
-                    return Outcome(False, 'Download of %s timed out' % url)
+            with open(part.path, 'ab'):
+                pass
+            return filename, file_path, part
         except OSError:
             #print('%s did not work, trying another...' % file_path)
             pass
-            # testing
-    # this should really never happen
-    return Outcome(False, 'Somehow none of the filenames we tried worked')
+    return None
+
+
+class PartFile:
+    '''A download in progress, staged next to its final destination. The
+       url and a validator (ETag or Last-Modified) of the partial content
+       are kept in a small .info file so that it can be safely resumed,
+       along with how far the download has got: the size of the file
+       says nothing once space has been reserved for the rest of it.
+       Segmented downloads record how far each segment has got, their
+       threads sharing the part.'''
+    def __init__(self, file_path, url):
+        self.path = file_path + '.part'
+        self.info_path = self.path + '.info'
+        self.url = url
+        self.offset = 0
+        self.shift = 0
+        self.validator = None
+        self.segments = []
+        self.lock = Lock()
+        try:
+            with open(self.info_path, 'r') as f:
+                info = json.load(f)
+            if info['url'] == url and info['validator'] and \
+                    os.path.isfile(self.path):
+                self.validator = info['validator']
+                if 'segments' in info:
+                    self.segments = [Segment(*x) for x in info['segments']]
+                else:
+                    size = os.path.getsize(self.path)
+                    self.offset = min(info.get('offset', size), size)
+                    self.shift = info.get('shift', 0)
+                    if self.offset < self.shift:
+                        # did not get as far as writing the tag
+                        self.offset = self.shift = 0
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def headers(self):
+        '''Request headers asking for the rest of the file, provided that
+           it has not changed since the part was downloaded. Bytes added
+       to the start of the file (shift) do not count.'''
+        if not self.offset:
+            return {}
+        return {'Range': 'bytes=%s-' % (self.offset - self.shift),
+                'If-Range': self.validator}
+
+    def accepts(self, r):
+        '''Whether the response can be written to the part as is: either
+           the remainder asked for or a complete file'''
+        if r.status_code == 206:
+            return range_start(r) == self.offset - self.shift
+        return r.status_code != 416
+
+    def open(self, r):
+        '''Open the part for writing. Appends if the server honoured the
+           range request; otherwise the download starts from scratch.'''
+        if r.status_code != 206:
+            self.offset = self.shift = 0
+        self.validator = strong_validator(r.headers)
+        self.save()
+        if not self.offset:
+            return open(self.path, 'wb')
+        f = open(self.path, 'r+b')
+        f.seek(self.offset)
+        # drop whatever was written or reserved past the recorded offset
+        f.truncate()
+        return f
+
+    def split(self, size, number, validator):
+        '''Set up a segmented download: a full size file and number
+           segments to fill it'''
+        self.validator = validator
+        step = -(-size // number)
+        self.segments = [Segment(start, start, min(start + step, size) - 1)
+                         for start in range(0, size, step)]
+        with open(self.path, 'wb') as f:
+            f.truncate(size)
+            if hasattr(os, 'posix_fallocate'):
+                allocate(f, 0, size)
+        self.save()
+
+    def save(self):
+        '''Write what is needed to resume (if anything) to the info file'''
+        if not self.validator:
+            delete_file(self.info_path)
+            return
+        info = {'url': self.url, 'validator': self.validator}
+        if self.segments:
+            info['segments'] = [[x.start, x.saved, x.end]
+                                for x in self.segments]
+        elif self.offset:
+            info['offset'] = self.offset
+        if self.shift:
+            info['shift'] = self.shift
+        with self.lock:
+            with open(self.info_path + '.tmp', 'w') as f:
+                json.dump(info, f)
+            os.replace(self.info_path + '.tmp', self.info_path)
+
+    def checkpoint(self, f, segment=None):
+        '''Make sure what has been written to f (for segment, if any) is
+           on disk, then record how far the download has got, so that a
+           download that is killed resumes from there. The other segments
+           are recorded as far as they had got at their own last
+           checkpoint, as what they have written since may not be on disk
+           yet.'''
+        f.flush()
+        os.fsync(f.fileno())
+        if segment is not None:
+            segment.saved = segment.pos
+        elif not self.segments:
+            self.offset = f.tell()
+        self.save()
+
+    def finish(self, file_path):
+        '''Atomically move the completed download into place'''
+        os.replace(self.path, file_path)
+        delete_file(self.info_path)
+
+    def discard(self):
+        delete_file(self.path)
+        delete_file(self.info_path)
+        self.offset = self.shift = 0
+        self.validator = None
+        self.segments = []
+
+
+class Segment:
+    '''A byte range of a segmented download, how far it has got and how
+       far it is known to have got on disk (saved)'''
+    def __init__(self, start, pos, end):
+        self.start = start
+        self.pos = pos
+        self.saved = pos
+        self.end = end
+
+
+def delete_stale_parts(sub_dir, keep, settings):
+    '''Delete partial downloads other than those of the entries in keep'''
+    keep_paths = set()
+    for entry in keep:
+        keep_paths.update(os.path.join(sub_dir, filename + '.part')
+                          for filename in filenames(entry, settings))
+    try:
+        dir_entries = list(os.scandir(sub_dir))
+    except OSError:
+        return
+    for dir_entry in dir_entries:
+        if dir_entry.name.endswith('.part') and \
+                dir_entry.path not in keep_paths:
+            delete_file(dir_entry.path)
+            delete_file(dir_entry.path + '.info')
 
 def download_img_file(url, sub_dir, settings):
     '''Download an image file'''
     try:
-        r = requests.get(url, timeout=60)
+        r = connections.session(settings).get(url, timeout=60)
     except requests.exceptions.RequestException:
         return Outcome(False, 'Download of %s failed' % url)
     content_type = r.headers['content-type'].lower()
@@ -106,10 +589,22 @@ def delete_file(file_path):
         return Outcome(False, 'Could not delete %s' % file_path)
 
 
-def verify_file(entry):
-    '''Check to see if recorded file exists or has been removed'''
-    isfile = os.path.isfile(entry['poca_abspath'])
-    return Outcome(isfile, entry['poca_abspath'] + ' exists: ' + str(isfile))
+def list_files(directory):
+    '''The paths of the files in directory, from a single listing rather
+       than a lookup per file'''
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.path for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+
+def dir_mtime(directory):
+    '''Modification time of directory in nanoseconds, None if missing'''
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
 
 
 def check_path(check_dir):
@@ -141,16 +636,10 @@ def check_file_write(check_file):
     outcome = check_path(os.path.dirname(check_file))
     return outcome
 
-def delete_sub(conf, title, reset=False):
-    '''Delete subscription files (optionally including history)'''
+def delete_sub(conf, title):
+    '''Delete subscription files'''
     sub_dir = os.path.join(conf.xml.settings.base_dir.text, title)
-    db_file = os.path.join(conf.paths.db_dir, title)
     try:
         shutil.rmtree(sub_dir)
     except FileNotFoundError:
         pass
-    if reset:
-        try:
-            os.remove(db_file)
-        except FileNotFoundError:
-            pass
@@ -8,8 +8,12 @@
 """Keeping records of downloaded files"""
 
 import os
+import time
 import pickle
+import sqlite3
+import threading
 
+from lxml import etree
 from poca import files
 from poca.outcome import Outcome
 
@@ -32,42 +36,388 @@ def open_jar(db_filename):
     return jar, outcome
 
 
+HISTORY_FILE = 'history.sqlite'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    title TEXT PRIMARY KEY,
+    sub TEXT,
+    etag TEXT,
+    modified TEXT,
+    track_no INTEGER,
+    fingerprint TEXT,
+    dir_mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    subscription TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    position INTEGER NOT NULL,
+    title TEXT,
+    url TEXT,
+    path TEXT,
+    published TEXT,
+    entry BLOB NOT NULL,
+    PRIMARY KEY (subscription, uid)
+);
+CREATE INDEX IF NOT EXISTS episode_order
+    ON episodes (subscription, deleted, position);
+"""
+LOCK = threading.Lock()
+HISTORIES = {}
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+
+def get_history(paths):
+    '''Returns the history database shared by all subscriptions'''
+    db_filename = os.path.join(paths.db_dir, HISTORY_FILE)
+    with LOCK:
+        if db_filename not in HISTORIES:
+            HISTORIES[db_filename] = History(db_filename)
+        return HISTORIES[db_filename]
+
+
 def get_subjar(paths, sub):
-    '''Returns existing jar if any, else creates a new one'''
-    db_filename = os.path.join(paths.db_dir, sub.title.text)
+    '''Returns existing jar if any, else creates a new one. A jar left by
+       an earlier version of poca is moved into the database first.'''
+    try:
+        history = get_history(paths)
+        jar = history.load(sub.title)
+        if jar is not None:
+            return jar, Outcome(True, 'Jar loaded')
+    except sqlite3.Error as e:
+        return None, Outcome(False, 'Could not read history from %s: %s'
+                             % (os.path.join(paths.db_dir, HISTORY_FILE), e))
+    db_filename = os.path.join(paths.db_dir, sub.title)
     if os.path.isfile(db_filename):
-        jar, outcome = open_jar(db_filename)
-    else:
-        jar = Subjar(paths, sub)
-        outcome = Outcome(True, 'New jar created')
-    if outcome.success is True:
-        jar.db_filename = db_filename
+        old_jar, outcome = open_jar(db_filename)
+        if not outcome.success:
+            return None, outcome
+        return history.migrate(old_jar, sub.title, db_filename)
+    jar = Subjar(history, sub.title, sub.xml_string)
+    outcome = jar.save()
     return jar, outcome
 
 
+def delete_subjar(paths, title):
+    '''Forget everything about a subscription'''
+    try:
+        get_history(paths).delete_subscription(title)
+    except sqlite3.Error:
+        pass
+    files.delete_file(os.path.join(paths.db_dir, title))
+
+
+def published(entry):
+    '''Publication date in a format SQLite understands'''
+    try:
+        return time.strftime('%Y-%m-%d %H:%M:%S', entry['published_parsed'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class History:
+    '''The history of every subscription in a single SQLite database.
+       Jars change it one episode at a time, each change a transaction of
+       its own. Changes are appended to the write-ahead log and only
+       copied into the database proper by checkpoint() (or on the next
+       start if poca was interrupted). The database can be queried
+       directly, see episodes().'''
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_filename, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        # the log is synced at checkpoints, not on every commit
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('PRAGMA wal_autocheckpoint = 0')
+        self.conn.executescript(SCHEMA)
+        self.upgrade_schema()
+        self.checkpoint()
+
+    def upgrade_schema(self):
+        '''Add columns missing from databases made by earlier versions'''
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(subscriptions)')]
+        for column, kind in (('fingerprint', 'TEXT'),
+                             ('dir_mtime', 'INTEGER')):
+            if column not in columns:
+                with self.conn:
+                    self.conn.execute('ALTER TABLE subscriptions '
+                                      'ADD COLUMN %s %s' % (column, kind))
+
+    def checkpoint(self):
+        '''Move logged changes into the database and empty the log'''
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def load(self, title):
+        '''Returns the jar of a subscription or None if there is none'''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT sub, etag, modified, track_no, fingerprint, '
+                'dir_mtime FROM subscriptions '
+                'WHERE title = ?', (title,)).fetchone()
+            if row is None:
+                return None
+            episodes = self.conn.execute(
+                'SELECT uid, deleted, entry FROM episodes '
+                'WHERE subscription = ? ORDER BY deleted, position',
+                (title,)).fetchall()
+        sub_xml, etag, modified, track_no, fingerprint, dir_mtime = row
+        jar = Subjar(self, title, sub_xml)
+        jar.etag, jar.modified = etag, modified
+        jar.fingerprint, jar.dir_mtime = fingerprint, dir_mtime
+        if track_no is not None:
+            jar.track_no = track_no
+        old_entries = []
+        for uid, deleted, entry in episodes:
+            lst, dic = (jar.del_lst, jar.del_dic) if deleted else \
+                (jar.lst, jar.dic)
+            lst.append(uid)
+            entry = pickle.loads(entry)
+            if not isinstance(entry, Episode):
+                entry = Episode.from_entry(entry)
+                old_entries.append((pickle.dumps(entry, PROTOCOL), title,
+                                    uid))
+            dic[uid] = entry
+        if old_entries:
+            # full feed entries stored by poca 1.1, only done once
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    'UPDATE episodes SET entry = ? '
+                    'WHERE subscription = ? AND uid = ?', old_entries)
+        return jar
+
+    def migrate(self, old_jar, title, db_filename):
+        '''Move a pickled jar into the database. The pickle is kept (with
+           a .migrated suffix) in case the user wants to go back.'''
+        jar = Subjar(self, title,
+                     etree.tostring(old_jar.sub, encoding='unicode'))
+        jar.etag = getattr(old_jar, 'etag', None)
+        jar.modified = getattr(old_jar, 'modified', None)
+        if hasattr(old_jar, 'track_no'):
+            jar.track_no = old_jar.track_no
+        jar.lst = list(old_jar.lst)
+        jar.dic = {uid: Episode.from_entry(entry)
+                   for uid, entry in old_jar.dic.items()}
+        jar.del_lst = list(getattr(old_jar, 'del_lst', []))
+        jar.del_dic = {uid: Episode.from_entry(entry) for uid, entry
+                       in getattr(old_jar, 'del_dic', {}).items()}
+        rows = [self.row(title, uid, False, position, jar.dic[uid])
+                for position, uid in enumerate(jar.lst)]
+        rows.extend(self.row(title, uid, True, position, jar.del_dic[uid])
+                    for position, uid in enumerate(jar.del_lst))
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    'DELETE FROM episodes WHERE subscription = ?', (title,))
+                self.conn.executemany(
+                    'INSERT INTO episodes (subscription, uid, deleted, '
+                    'position, title, url, path, published, entry) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.conn.execute(*self.sub_row(jar))
+            os.replace(db_filename, db_filename + '.migrated')
+        except (sqlite3.Error, pickle.PickleError, OSError) as e:
+            return None, Outcome(False, 'Could not move history of %s to '
+                                 '%s: %s' % (title, self.db_filename, e))
+        return jar, Outcome(True, 'Jar migrated')
+
+    def row(self, title, uid, deleted, position, entry):
+        return (title, uid, int(deleted), position, entry.get('title'),
+                entry.get('poca_url'), entry.get('poca_abspath'),
+                published(entry), pickle.dumps(entry, PROTOCOL))
+
+    def sub_row(self, jar):
+        '''Statement saving the subscription part of the jar'''
+        return ('INSERT OR REPLACE INTO subscriptions (title, sub, etag, '
+                'modified, track_no, fingerprint, dir_mtime) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (jar.title, jar.sub, jar.etag, jar.modified,
+                 getattr(jar, 'track_no', None), jar.fingerprint,
+                 jar.dir_mtime))
+
+    def save(self, jar):
+        with self.lock, self.conn:
+            self.conn.execute(*self.sub_row(jar))
+
+    def save_track_no(self, jar):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE subscriptions SET track_no = ? WHERE title = ?',
+                (jar.track_no, jar.title))
+
+    def insert(self, jar, uid, deleted, position, entry):
+        '''Insert an episode at position in the (deleted) list'''
+        row = self.row(jar.title, uid, deleted, position, entry)
+        with self.lock, self.conn:
+            self.unlink(jar.title, uid)
+            self.conn.execute(
+                'UPDATE episodes SET position = position + 1 '
+                'WHERE subscription = ? AND deleted = ? AND position >= ?',
+                (jar.title, int(deleted), position))
+            self.conn.execute(
+                'INSERT INTO episodes (subscription, uid, deleted, position, '
+                'title, url, path, published, entry) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def delete(self, jar, uid):
+        with self.lock, self.conn:
+            self.unlink(jar.title, uid)
+
+    def unlink(self, title, uid):
+        '''Delete an episode and close the gap it leaves in its list'''
+        row = self.conn.execute(
+            'SELECT deleted, position FROM episodes '
+            'WHERE subscription = ? AND uid = ?', (title, uid)).fetchone()
+        if row is None:
+            return
+        self.conn.execute(
+            'DELETE FROM episodes WHERE subscription = ? AND uid = ?',
+            (title, uid))
+        self.conn.execute(
+            'UPDATE episodes SET position = position - 1 '
+            'WHERE subscription = ? AND deleted = ? AND position > ?',
+            (title,) + row)
+
+    def delete_subscription(self, title):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM episodes WHERE subscription = ?',
+                              (title,))
+            self.conn.execute('DELETE FROM subscriptions WHERE title = ?',
+                              (title,))
+
+    def episodes(self, title=None, deleted=False):
+        '''Yields (subscription, uid, title, url, path, published) of kept
+           (or user deleted) episodes, oldest first, for use by tools'''
+        query = 'SELECT subscription, uid, title, url, path, published ' \
+            'FROM episodes WHERE deleted = ?'
+        params = [int(deleted)]
+        if title is not None:
+            query += ' AND subscription = ?'
+            params.append(title)
+        query += ' ORDER BY subscription, published'
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return iter(rows)
+
+
 class Subjar:
-    '''Creates standard subscription info container with save method'''
-    def __init__(self, paths, sub):
-        self.db_filename = str()
+    '''The history of a single subscription: the episodes we have (lst and
+       dic), those the user has deleted (del_lst and del_dic), the settings
+       it was last planned with (sub, as xml) and what we need to make a
+       conditional request for the feed or, failing that, tell whether it
+       has changed'''
+    def __init__(self, history, title, sub):
+        self.history = history
+        self.title = title
         self.sub = sub
         self.etag = None
         self.modified = None
+        self.fingerprint = None
+        self.dir_mtime = None
         self.lst = []
         self.dic = {}
         self.del_lst = []
         self.del_dic = {}
 
     def save(self):
-        '''Saves jar instance to file using pickle'''
+        '''Saves subscription settings, validators, fingerprint and track
+           number'''
+        return self.commit(self.history.save, self)
+
+    def set_track_no(self, track_no):
+        self.track_no = track_no
+        return self.commit(self.history.save_track_no, self)
+
+    def checkpoint(self):
+        '''Called when the subscription is done with for this run'''
+        return self.commit(self.history.checkpoint)
+
+    def add(self, uid, entry, index):
+        '''Add a downloaded episode at index'''
+        self.lst.insert(index, uid)
+        self.dic[uid] = Episode.from_entry(entry)
+        return self.commit(self.history.insert, self, uid, False,
+                           self.lst.index(uid), self.dic[uid])
+
+    def remove(self, uid):
+        '''Forget an episode whose file we have deleted'''
+        self.lst.remove(uid)
+        del self.dic[uid]
+        return self.commit(self.history.delete, self, uid)
+
+    def mark_deleted(self, uid):
+        '''Move an episode the user has deleted to the deleted list'''
+        self.lst.remove(uid)
+        self.del_lst.append(uid)
+        self.del_dic[uid] = self.dic.pop(uid)
+        return self.commit(self.history.insert, self, uid, True,
+                           len(self.del_lst) - 1, self.del_dic[uid])
+
+    def commit(self, func, *args):
         try:
-            with open(self.db_filename, 'wb') as f:
-                pickle.dump(self, f)
-            outcome = Outcome(True, 'Pickle successful')
-        except (pickle.PickleError, PermissionError, FileNotFoundError,
-                IsADirectoryError):
-            outcome = Outcome(False, 'Could not save history to %s' %
-                              self.db_filename)
-        return outcome
+            func(*args)
+            return Outcome(True, 'History saved')
+        except (sqlite3.Error, pickle.PickleError) as e:
+            return Outcome(False, 'Could not save history to %s: %s' %
+                           (self.history.db_filename, e))
+
+
+class Episode:
+    '''What poca needs to remember of a feed entry once it has been
+       downloaded. Summaries, content, links etc. are left out. Supports
+       enough of the dict interface to stand in for the entry.'''
+    __slots__ = ('poca_url', 'poca_abspath', 'filename', 'org_filename',
+                 'poca_filename', 'title', 'published_parsed', 'names',
+                 'poca_mb', 'user_vars', 'unique_filename')
+    # only valid, expanded entries are downloaded
+    valid = True
+    expanded = True
+
+    @classmethod
+    def from_entry(cls, entry):
+        if isinstance(entry, cls):
+            return entry
+        episode = cls()
+        for key in cls.__slots__:
+            if key in entry:
+                setattr(episode, key, entry[key])
+        # 1.0 entries do not have the 'org_filename' key
+        if 'org_filename' not in entry and 'filename' in entry:
+            episode.org_filename = entry['filename']
+        return episode
+
+    def __getitem__(self, key):
+        if key in self.__slots__ or key in ('valid', 'expanded'):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.keys()}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
 
 
 def get_statejar(paths):
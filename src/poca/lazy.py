@@ -0,0 +1,26 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Deferring the import of modules that only some runs need"""
+
+import importlib
+
+
+class LazyModule:
+    '''Stands in for a module that is imported the first time one of its
+       attributes is used, so that a run that never downloads, tags or
+       parses a feed does not pay for importing requests, mutagen or
+       feedparser. Safe to use from several threads (the import system
+       takes care of that).'''
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name), attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__name
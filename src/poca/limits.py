@@ -0,0 +1,153 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Process-wide limits on downloading: bandwidth, connections per host and
+   bytes per run"""
+
+import time
+import threading
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit
+
+
+Limits = namedtuple('Limits', 'rate_kb host_connections run_mb')
+
+LOCK = threading.Lock()
+SHARED = []
+
+
+class BudgetSpent(Exception):
+    '''The bytes allowed for this run have been downloaded'''
+
+
+class TokenBucket:
+    '''Lets rate bytes a second through on average, in bursts of up to a
+       second's worth. Threads taking more than there is run up a debt
+       that the next ones wait off, so that together they keep to the
+       rate.'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        '''Returns the seconds to wait before passing on size bytes'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            return max(-self.tokens / self.rate, 0)
+
+
+class Budget:
+    '''Bytes that may still be downloaded'''
+    def __init__(self, size):
+        self.left = size
+        self.lock = threading.Lock()
+
+    def spend(self, size):
+        with self.lock:
+            self.left -= size
+
+    def spent(self):
+        return self.left <= 0
+
+
+class HostSlots:
+    '''Number of connections open to each host'''
+    def __init__(self):
+        self.open = Counter()
+        self.cond = threading.Condition()
+
+    def acquire(self, host, cap, my_thread):
+        '''Wait until fewer than cap connections are open to host and count
+           one more. Returns False if the download was cancelled while
+           waiting.'''
+        with self.cond:
+            while cap and self.open[host] >= cap:
+                if getattr(my_thread, "kill", False):
+                    return False
+                self.cond.wait(0.5)
+            self.open[host] += 1
+            return True
+
+    def release(self, host):
+        with self.cond:
+            self.open[host] -= 1
+            self.cond.notify_all()
+
+
+class Shared:
+    '''The limits of the settings, shared by all subscriptions'''
+    def __init__(self, settings):
+        rate_kb = int(settings.rate_kb)
+        run_mb = int(settings.run_mb)
+        self.bucket = TokenBucket(rate_kb * 1024) if rate_kb > 0 else None
+        self.budget = Budget(run_mb * 1048576) if run_mb > 0 else None
+        self.host_connections = int(settings.host_connections)
+        self.hosts = HostSlots()
+
+
+def get_shared(settings):
+    '''Returns the limits shared by all threads, set up on first use'''
+    with LOCK:
+        if not SHARED:
+            SHARED.append(Shared(settings))
+        return SHARED[0]
+
+
+class Limiter:
+    '''The limits applying to the downloads of a subscription: those of
+       the settings, which all subscriptions count towards, and those set
+       for the subscription itself (limits, if any). The bandwidth and
+       byte budget of a subscription come on top of the shared ones; its
+       host_connections replaces the one of the settings.'''
+    def __init__(self, settings, limits=None):
+        shared = get_shared(settings)
+        limits = limits or Limits(None, None, None)
+        self.buckets = [bucket for bucket in (
+            shared.bucket,
+            TokenBucket(limits.rate_kb * 1024) if limits.rate_kb else None)
+            if bucket is not None]
+        self.budgets = [budget for budget in (
+            shared.budget,
+            Budget(limits.run_mb * 1048576) if limits.run_mb else None)
+            if budget is not None]
+        self.host_connections = shared.host_connections \
+            if limits.host_connections is None else limits.host_connections
+        self.hosts = shared.hosts
+
+    def connect(self, url, my_thread):
+        '''Wait for a connection to the host of url to be allowed. Returns
+           False if cancelled meanwhile.'''
+        return self.hosts.acquire(urlsplit(url).hostname,
+                                  self.host_connections, my_thread)
+
+    def disconnect(self, url):
+        self.hosts.release(urlsplit(url).hostname)
+
+    def spent(self):
+        '''Whether there is nothing left to download'''
+        return any(budget.spent() for budget in self.budgets)
+
+    def check(self):
+        '''Raises BudgetSpent if there is nothing left to download'''
+        if self.spent():
+            raise BudgetSpent()
+
+    def passed(self, size, my_thread):
+        '''Account for size bytes downloaded, waiting as long as the
+           bandwidth limits call for'''
+        for budget in self.budgets:
+            budget.spend(size)
+        wait = max([bucket.take(size) for bucket in self.buckets] or [0])
+        while wait > 0 and not getattr(my_thread, "kill", False):
+            time.sleep(min(wait, 0.5))
+            wait -= 0.5
@@ -9,14 +9,17 @@
 
 import logging
 from logging import handlers
-import smtplib
 import socket
-from email.mime.text import MIMEText
-from email.header import Header
 
 from poca import history
+from poca.lazy import LazyModule
 from poca.outcome import Outcome
 
+# only needed for sending email
+smtplib = LazyModule('smtplib')
+mime_text = LazyModule('email.mime.text')
+header = LazyModule('email.header')
+
 
 def get_logger(logger_name):
     '''Initialises and returns a basic, generic logger'''
@@ -123,10 +126,10 @@ class BufferSMTPHandler(handlers.BufferingHandler):
         body = str()
         for record in self.buffer:
             body = body + self.format(record) + "\r\n"
-        msg = MIMEText(body.encode('utf-8'), _charset="utf-8")
+        msg = mime_text.MIMEText(body.encode('utf-8'), _charset="utf-8")
         msg['From'] = self.email.fromaddr.text
         msg['To'] = self.email.toaddr.text
-        msg['Subject'] = Header("POCA log")
+        msg['Subject'] = header.Header("POCA log")
         if self.email.starttls == 'yes':
             try:
                 smtp = smtplib.SMTP(self.email.host.text, 587, timeout=10)
@@ -28,6 +28,8 @@ PLANREM_DIC = {'default': '\u2796', 'ascii': '-', 'wsl': '-', \
                'emoji': '\U0001f44e'}
 DOWNLOAD_DIC = {'default': '\u21af', 'ascii': '>', 'wsl': '\u21af', \
                 'emoji': '\U0001f4be'}
+TAG_DIC = {'default': '\u270e', 'ascii': '#', 'wsl': '\u270e', \
+           'emoji': '\U0001f3f7\ufe0f'}
 
 
 # ####################################### #
@@ -64,9 +66,9 @@ def config_fatal(msg):
 
 def plans_error(subdata):
     '''sub-fatal errors encountered processing a specific subscription'''
-    stream_msg = '%s. %s' % (subdata.sub.title.text.upper(),
+    stream_msg = '%s. %s' % (subdata.sub.title.upper(),
                              subdata.outcome.msg)
-    after_stream_msg = 'SUB ERROR (%s): %s' % (subdata.sub.title.text,
+    after_stream_msg = 'SUB ERROR (%s): %s' % (subdata.sub.title,
                                                subdata.outcome.msg)
     STREAM.debug(stream_msg)
     AFTER_STREAM.info(after_stream_msg)
@@ -75,8 +77,8 @@ def plans_error(subdata):
 
 def plans_moved(subdata, _outcome):
     '''Sub has moved (http status 301) - succes/failure in updating config'''
-    stream_msg = '%s. %s' % (subdata.sub.title.text.upper(), _outcome.msg)
-    after_stream_msg = 'SUB MOVE (301) (%s): %s' % (subdata.sub.title.text,
+    stream_msg = '%s. %s' % (subdata.sub.title.upper(), _outcome.msg)
+    after_stream_msg = 'SUB MOVE (301) (%s): %s' % (subdata.sub.title,
                                                     _outcome.msg)
     STREAM.debug(stream_msg)
     AFTER_STREAM.info(after_stream_msg)
@@ -85,7 +87,7 @@ def plans_moved(subdata, _outcome):
 
 def plans_nochanges(subdata):
     '''No changes made, just output title'''
-    msg = subdata.sub.title.text.upper()
+    msg = subdata.sub.title.upper()
     STREAM.info(msg)
 
 
@@ -94,7 +96,7 @@ def plans_upgrade(subdata):
     USERDEL = USERDEL_DIC[STREAM.glyphs]
     PLANADD = PLANADD_DIC[STREAM.glyphs]
     PLANREM = PLANREM_DIC[STREAM.glyphs]
-    msg = subdata.sub.title.text.upper()
+    msg = subdata.sub.title.upper()
     no_udeleted = len(subdata.udeleted)
     no_unwanted = len(subdata.unwanted)
     no_lacking = len(subdata.lacking)
@@ -145,6 +147,13 @@ def processing_download(entry):
     STREAM.debug(msg)
 
 
+def processing_tag(outcome):
+    '''Subline telling user how much of the file tagging rewrote'''
+    TAG = TAG_DIC[STREAM.glyphs]
+    msg = '   %s %s' % (TAG, outcome.msg)
+    STREAM.debug(msg)
+
+
 # ####################################### #
 # FAIL                                    #
 # ####################################### #
@@ -197,7 +206,7 @@ def after_stream_flush():
 # file operations summary (for file log)
 def file_summary(subdata, removed, downed, failed):
     '''Print summary to log'''
-    title = subdata.sub.title.text.upper()
+    title = subdata.sub.title.upper()
     if subdata.udeleted:
         udeleted_files = [x['filename'] for x in subdata.udeleted]
         SUMMARY.info(title + '. User deleted: ' + ', '.join(udeleted_files))
@@ -212,6 +221,13 @@ def file_summary(subdata, removed, downed, failed):
         SUMMARY.error(title + '. Failed: ' + ', '.join(failed_files))
 
 
+def connection_stats(stats):
+    '''Connection reuse for downloads (verbose only)'''
+    msg = 'Downloads: %s requests over %s new connections (%s reused)' % \
+        (stats.requests, stats.connections, stats.reused)
+    STREAM.debug(msg)
+
+
 def email_summary():
     '''Empty out buffered email logs (if needed)'''
     if SUMMARY.poca_email_handler:
@@ -0,0 +1,137 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""The event loop dispatching subscriptions to worker pools"""
+
+from collections import namedtuple
+from queue import Queue
+from threading import Thread, enumerate as all_threads
+
+from poca import fetch, output, subscribe, subupdate, subupgrade, tag
+from poca.outcome import Outcome
+from poca.workers import Job, WorkerPool
+
+
+# stands in for the subdata of a subscription that could not be prepared
+Failed = namedtuple('Failed', 'sub outcome')
+
+
+class Scheduler:
+    '''Prepares and plans subscription updates on one pool, fetches feeds
+       on the event loop of a fetcher and upgrades subscriptions on a
+       second pool. Each stage is dispatched by the main thread as soon
+       as the previous one has completed. If tag_processes is set, files
+       are tagged in a pool of processes shared by the upgrades.'''
+    def __init__(self, args, conf, feed_connections, upgrade_threads):
+        self.args = args
+        self.conf = conf
+        self.events = Queue()
+        self.fetcher = fetch.Fetcher(conf.xml.settings,
+                                     limit=feed_connections)
+        # feeds are fetched without blocking, this is for jars and parsing
+        self.update_pool = WorkerPool(min(feed_connections, 4))
+        self.upgrade_pool = WorkerPool(upgrade_threads)
+        processes = int(conf.xml.settings.tag_processes)
+        self.tag_pool = tag.TagPool(conf.xml.settings, processes) \
+            if processes > 0 else None
+
+    def run(self, subs):
+        '''Returns when every subscription has been updated and, if needed,
+           upgraded'''
+        feeder = Thread(target=self.submit_updates, args=(subs,))
+        feeder.daemon = True
+        feeder.start()
+        pending = len(subs)
+        while pending:
+            job = self.events.get()
+            if job.error is not None:
+                # only the subscription at hand is given up on
+                self.failed(job)
+                pending -= 1
+                continue
+            if job.stage == 'prepare' and self.prepared(job.result):
+                continue
+            if job.stage == 'fetch':
+                subdata, response = job.result
+                self.update_pool.submit(subdata.plan, response,
+                                        callback=self.events.put,
+                                        stage='update')
+                continue
+            if job.stage == 'update' and self.planned(job.result):
+                continue
+            pending -= 1
+        self.update_pool.shutdown()
+        self.upgrade_pool.shutdown()
+        if self.tag_pool is not None:
+            self.tag_pool.shutdown()
+        self.fetcher.close()
+
+    def failed(self, job):
+        '''Report a subscription whose update or upgrade raised'''
+        if job.stage == 'prepare':
+            sub = job.args[1]
+        elif job.stage == 'update':
+            sub = job.func.__self__.sub
+        else:
+            sub = job.args[0].sub
+        outcome = Outcome(False, 'Unexpected error (%s): %s' %
+                          (type(job.error).__name__, job.error))
+        output.plans_error(Failed(sub, outcome))
+
+    def submit_updates(self, subs):
+        for sub in subs:
+            self.update_pool.submit(subupdate.SubUpdate, self.conf, sub,
+                                    callback=self.events.put,
+                                    stage='prepare')
+
+    def prepared(self, subdata):
+        '''Handle a subscription ready to be fetched. Returns True if the
+           fetch was started.'''
+        if subdata.outcome.success is False:
+            output.plans_error(subdata)
+            return False
+
+        def fetched(response):
+            job = Job(None, (), stage='fetch')
+            job.result = (subdata, response)
+            self.events.put(job)
+        self.fetcher.submit(subdata.sub.url, subdata.etag,
+                            subdata.modified, callback=fetched)
+        return True
+
+    def planned(self, subdata):
+        '''Handle a finished update. Returns True if an upgrade was
+           dispatched.'''
+        if subdata.outcome.success is False:
+            output.plans_error(subdata)
+            return False
+        if subdata.status == 301:
+            _outcome = subscribe.update_url(self.args, subdata)
+            output.plans_moved(subdata, _outcome)
+        if subdata.status == 304:
+            output.plans_nochanges(subdata)
+            return False
+        self.upgrade_pool.submit(self.upgrade, subdata,
+                                 callback=self.events.put, stage='upgrade')
+        return True
+
+    def upgrade(self, subdata):
+        '''Announce the plans when work begins so verbose output is not
+           interleaved with that of other subscriptions'''
+        output.plans_upgrade(subdata)
+        return subupgrade.SubUpgrade(subdata, self.tag_pool)
+
+    def kill(self):
+        '''Cancel everything and wait for running upgrades to clean up'''
+        self.update_pool.kill()
+        self.upgrade_pool.kill()
+        # upgrades may have started pools of their own
+        for thread in all_threads():
+            setattr(thread, "kill", True)
+        self.upgrade_pool.shutdown()
+        if self.tag_pool is not None:
+            self.tag_pool.shutdown(wait=False)
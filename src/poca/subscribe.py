@@ -13,13 +13,15 @@ import copy
 import fcntl
 from lxml import objectify
 from argparse import Namespace
-from mutagen.easyid3 import EasyID3
 
-from poca import files, config
+from poca import files, config, history, feedcache
+from poca.lazy import LazyModule
 from poca.lxmlfuncs import pretty_print
 from poca.feedstats import Feedstats
 from poca.outcome import Outcome
 
+easyid3 = LazyModule('mutagen.easyid3')
+
 
 def search(xml, args):
     '''Takes a query and returns subscriptions with matching titles'''
@@ -66,7 +68,9 @@ def delete(conf, args):
             continue
         else:
             conf.xml.subscriptions.remove(result)
-            files.delete_sub(conf, result.title.text, reset=True)
+            files.delete_sub(conf, result.title.text)
+            history.delete_subjar(conf.paths, result.title.text)
+            feedcache.delete(conf.paths, result.url.text)
     write(conf)
 
 
@@ -189,7 +193,7 @@ def list_subs(conf):
 
 def list_valid_tags(args):
     '''list valid tags to use in metadata overrides'''
-    mp3_list = copy.copy(list(EasyID3.valid_keys.keys()))
+    mp3_list = copy.copy(list(easyid3.EasyID3.valid_keys.keys()))
     mp3_list.extend(['comment', 'chapters'])
     mp4_list = ['title', 'album', 'artist', 'albumartist', 'date', 'comment',
                 'description', 'grouping', 'genre', 'copyright', 'albumsort',
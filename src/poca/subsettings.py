@@ -0,0 +1,113 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Subscription settings compiled once into plain Python"""
+
+import hashlib
+from collections import namedtuple
+from copy import deepcopy
+
+from lxml import etree
+
+from poca.limits import Limits
+from poca.lxmlfuncs import merge
+from poca.outcome import Outcome
+
+
+Rename = namedtuple('Rename', 'tags divider space')
+
+
+def digest(xml_string):
+    '''Stable hash of subscription settings as stored in the history'''
+    return hashlib.sha1(xml_string.encode('utf-8')).hexdigest()
+
+
+class SubSettings:
+    '''The settings of a subscription merged with the defaults and read
+       into plain values, done once when the config is loaded. Instances
+       are read-only. The merged xml is kept as a string for the history;
+       its digest tells whether the settings have changed. outcome is a
+       failure if the settings are not valid.'''
+    __slots__ = ('title', 'url', 'max_number', 'from_the_top',
+                 'track_numbering', 'parallel_downloads', 'metadata',
+                 'filters', 'rename', 'limits', 'xml_string', 'digest',
+                 'outcome')
+
+    def __init__(self, sub_el, defaults_el):
+        # merge sub settings and defaults
+        merged = deepcopy(defaults_el)
+        rename = deepcopy(sub_el.rename) if hasattr(sub_el, 'rename') \
+            else None
+        errors = merge(sub_el, merged, defaults_el, errors=[])
+        merged.tag = 'subscription'
+        if rename is not None:
+            merged.rename = rename
+        xml_string = etree.tostring(merged, encoding='unicode')
+        values = {
+            'title': merged.title.text,
+            'url': merged.url.text,
+            'max_number': None,
+            'from_the_top': (merged.find('from_the_top') or 'no') == 'yes',
+            'track_numbering': self.text(merged, 'track_numbering') or 'no',
+            'parallel_downloads': 1,
+            'metadata': tuple((el.tag, el.text)
+                              for el in merged.xpath('./metadata/*')),
+            'filters': tuple((el.tag, el.text)
+                             for el in merged.xpath('./filters/*'))
+                       if hasattr(merged, 'filters') else None,
+            'rename': None,
+            'limits': Limits(None, None, None),
+            'xml_string': xml_string,
+            'digest': digest(xml_string),
+            'outcome': errors[0] if errors else Outcome(True, '')}
+        try:
+            if hasattr(merged, 'max_number'):
+                values['max_number'] = int(merged.max_number)
+        except ValueError:
+            values['outcome'] = Outcome(False, 'Bad max_number setting')
+        try:
+            values['parallel_downloads'] = \
+                int(merged.find('parallel_downloads') or 1)
+        except ValueError:
+            pass
+        try:
+            values['limits'] = Limits(
+                *(int(merged.find(key)) if hasattr(merged, key) else None
+                  for key in Limits._fields))
+        except (ValueError, TypeError):
+            values['outcome'] = Outcome(False, 'Bad download limit setting')
+        if hasattr(merged, 'rename'):
+            values['rename'] = Rename(
+                tuple(el.tag for el in merged.rename.iterchildren()),
+                merged.rename.get('divider') or ' ',
+                merged.rename.get('space') or ' ')
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    @staticmethod
+    def text(el, tag):
+        child = el.find(tag)
+        return child.text if child is not None else None
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Subscription settings are read-only')
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def __eq__(self, other):
+        return isinstance(other, SubSettings) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return 'SubSettings(%r, %s)' % (self.title, self.digest[:8])
@@ -10,54 +10,37 @@
 import os
 import re
 import time
-from copy import deepcopy
-from threading import Thread
+import hashlib
+from collections import Counter
 
-import feedparser
-from lxml import etree
-from poca import files, history, entryinfo
-from poca.lxmlfuncs import merge
+from poca import files, history, entryinfo, feedcache, feedxml, subsettings
+from poca.lazy import LazyModule
 from poca.outcome import Outcome
+from poca.uidlist import UidList
 
+# only needed for feeds the lxml parser leaves to it
+feedparser = LazyModule('feedparser')
 
-class SubUpdateThread(Thread):
-    '''A thread class that creates a SubData instance and puts it in the
-       queue'''
-    def __init__(self, queue, target, *args):
-        self.queue = queue
-        self.target = target
-        self.args = args
-        super(SubUpdateThread, self).__init__()
-        self.daemon = True
 
-    def run(self):
-        subdata = self.target(*self.args)
-        self.queue.put(subdata)
+# compiled filters by filter settings
+FILTERS = {}
 
 
 class SubUpdate():
     '''Data carrier for subscription: entries to dl, entries to remove,
-       user deleted entries, etc.'''
+       user deleted entries, etc. Jar and settings are prepared on creation,
+       the rest is planned once the feed has been fetched. sub is the
+       compiled SubSettings of the subscription.'''
     def __init__(self, conf, sub):
         self.conf = conf
         self.sub = sub
         self.status = 0
         self.sub_dir = os.path.join(self.conf.paths.base_dir,\
-                                    self.sub.title.text)
+                                    self.sub.title)
         self.outcome = files.check_path(self.sub_dir)
         if not self.outcome.success:
             return
-
-        # merge sub settings and defaults
-        defaults = deepcopy(self.conf.xml.defaults)
-        rename = deepcopy(self.sub.rename) if hasattr(self.sub, 'rename') \
-            else None
-        errors = merge(self.sub, defaults, self.conf.xml.defaults, errors=[])
-        self.outcome = errors[0] if errors else Outcome(True, '')
-        defaults.tag = "subscription"
-        self.sub = defaults
-        if rename is not None:
-            self.sub.rename = rename
+        self.outcome = self.sub.outcome
         if not self.outcome.success:
             return
 
@@ -71,18 +54,48 @@ class SubUpdate():
         if not self.outcome.success:
             return
 
-        # get feed, combine with jar and filter the lot
-        feed = Feed(self.sub, self.jar, self.udeleted)
+        # if settings have changed or files have been deleted, the feed is
+        # planned for again, from the cached copy if it has not changed
+        self.cached = None
+        self.changed = changed(self.sub, self.jar, self.udeleted)
+        if self.changed:
+            self.cached = feedcache.load(self.conf.paths, self.sub.url)
+            self.etag, self.modified = (self.cached.etag,
+                                        self.cached.modified) \
+                if self.cached else (None, None)
+        else:
+            self.etag = getattr(self.jar, 'etag', None)
+            self.modified = getattr(self.jar, 'modified', None)
+
+    def plan(self, response):
+        '''Combine the fetched feed with the jar and filter the lot'''
+        if response.status == 304 and self.cached is not None:
+            response = self.cached
+        self.fingerprint = fingerprint(response, self.sub)
+        if response.status == 200 and not self.changed and \
+                self.fingerprint is not None and \
+                self.fingerprint == self.jar.fingerprint:
+            # same feed, same settings: as good as a 304 (a 301 still has
+            # to reach the scheduler for the config to be updated)
+            self.status = 304
+            self.outcome = Outcome(True, 'Not modified')
+            return self
+        if response.status in (200, 301):
+            feedcache.save(self.conf.paths, self.sub.url, response)
+        # the jar allows reading only the new part of the feed, but not if
+        # things have changed and all of it needs looking at again
+        jar = None if self.changed else self.jar
+        feed = Feed(self.sub, response, self.etag, self.modified, jar)
         self.status = feed.status
         if self.status == 301:
             self.outcome = Outcome(True, 'Feed has moved. Config updated.')
             self.new_url = feed.href
         elif self.status == 304:
             self.outcome = Outcome(True, 'Not modified')
-            return
-        elif self.status >= 400:
+            return self
+        elif not 200 <= self.status < 300:
             self.outcome = Outcome(False, feed.bozo_exception)
-            return
+            return self
         else:
             self.outcome = Outcome(True, 'Success')
         combo = Combo(feed, self.jar, self.sub)
@@ -90,63 +103,106 @@ class SubUpdate():
                              self.sub_dir)
         self.outcome = self.wanted.outcome
         if not self.outcome.success:
-            return
-        from_the_top = self.sub.find('from_the_top') or 'no'
-        if from_the_top == 'no':
+            return self
+        if not self.sub.from_the_top:
             self.wanted.lst.reverse()
 
         # subupgrade will delete unwanted and download lacking
-        self.unwanted = [x for x in self.jar.lst if x not in self.wanted.lst]
-        self.lacking = [x for x in self.wanted.lst if x not in self.jar.lst]
+        self.unwanted = UidList(self.jar.lst).difference(self.wanted.lst)
+        self.lacking = self.wanted.lst.difference(self.jar.dic)
+        return self
 
     def check_jar(self):
-        '''Check for user deleted files so we can filter them out'''
-        for uid in self.jar.lst:
+        '''Check for user deleted files so we can filter them out. Each
+           directory is listed once instead of looking up every file, and
+           not at all if dir_mtime is on and the subscription directory
+           has not been modified since the last run.'''
+        self.outcome = Outcome(True, 'Jar checked')
+        directories = {os.path.dirname(self.jar.dic[uid]['poca_abspath'])
+                       for uid in self.jar.lst}
+        if self.conf.xml.settings.dir_mtime == 'yes' and \
+                directories <= {self.sub_dir} and \
+                self.jar.dir_mtime is not None and \
+                self.jar.dir_mtime == files.dir_mtime(self.sub_dir):
+            return
+        existing = set()
+        for directory in directories:
+            existing.update(files.list_files(directory))
+        for uid in list(self.jar.lst):
             entry = self.jar.dic[uid]
-            outcome = files.verify_file(entry)
-            if not outcome.success:
+            if entry['poca_abspath'] not in existing:
                 self.udeleted.append(entry)
-                self.jar.del_lst.append(uid)
-                self.jar.del_dic[uid] = self.jar.dic.pop(uid)
-        self.jar.lst = [x for x in self.jar.lst if x not in self.jar.del_lst]
-        self.outcome = self.jar.save()
+                outcome = self.jar.mark_deleted(uid)
+                if not outcome.success:
+                    self.outcome = outcome
+
+
+def changed(sub, jar, udeleted):
+    '''Whether the subscription settings have changed or files have been
+       deleted since last time, which calls for planning from scratch'''
+    return sub.digest != subsettings.digest(jar.sub) or bool(udeleted)
+
+
+def fingerprint(response, sub):
+    '''Hash of the feed and the settings it was planned with, for telling
+       whether anything has changed when the server cannot say'''
+    if response.status not in (200, 301) or response.body is None:
+        return None
+    return '%s:%s' % (hashlib.sha1(response.body).hexdigest(), sub.digest)
 
 
 class Feed:
-    '''Constructs a container for feed entries'''
-    def __init__(self, sub, jar, udeleted):
-        etag = getattr(jar, 'etag', None)
-        modified = getattr(jar, 'modified', None)
-        sub_str = etree.tostring(sub, encoding='unicode')
-        jarsub_str = etree.tostring(jar.sub, encoding='unicode')
-        if sub_str != jarsub_str or udeleted:
-            etag = None
-            modified = None
-        doc = feedparser.parse(sub.url.text, etag=etag, modified=modified)
-        self.status = getattr(doc, 'status', 418)
-        self.etag = getattr(doc, 'etag', etag)
-        self.modified = getattr(doc, 'modified', modified)
-        self.bozo_exception = getattr(doc, 'bozo_exception', str())
-        self.href = getattr(doc, 'href', sub.url.text)
-        self.set_entries(doc, sub)
+    '''Constructs a container for feed entries. Given a jar, the feed is
+       only read up to the point beyond which no entry could be wanted.'''
+    def __init__(self, sub, response, etag, modified, jar=None):
+        self.status = response.status
+        self.etag = response.etag or etag
+        self.modified = response.modified or modified
+        self.bozo_exception = response.error
+        self.href = response.href
+        self.lst, self.dic, self.image = UidList(), {}, None
+        if self.status in (200, 301):
+            # relative links are resolved against where the feed came from
+            headers = {'content-location': response.url}
+            headers.update(response.headers)
+            if jar is None or not self.set_new_entries(sub, response, jar,
+                                                       headers):
+                self.set_entries(parse(response.body, headers), sub)
+
+    def set_new_entries(self, sub, response, jar, headers):
+        '''Parse only the entries up to and including the first max_number
+           entries in the jar: anything after those can never be wanted.
+           Returns False if the whole feed has to be parsed after all.'''
+        enough = sub.max_number
+        if sub.from_the_top or enough is None:
+            return False
+        if enough <= 0 or len(jar.lst) < enough:
+            return False
+        body = feedxml.trim(response.body, response.url, jar.dic, enough)
+        if body is None:
+            return False
+        # the trimmed feed is utf-8 whatever the server said
+        headers = dict(headers, **{'content-type': 'application/xml'})
+        self.set_entries(parse(body, headers), sub)
+        # make sure the parser knows the entries by the same uids
+        return sum(uid in jar.dic for uid in self.lst) >= enough
 
     def set_entries(self, doc, sub):
         '''Extract entries from the feed xml'''
         try:
-            self.lst = [entry.id for entry in doc.entries]
+            self.lst = UidList(entry.id for entry in doc.entries)
             self.dic = {entry.id: entry for entry in doc.entries}
         except (KeyError, AttributeError):
             try:
-                self.lst = [entry.enclosures[0]['href']
-                            for entry in doc.entries]
+                self.lst = UidList(entry.enclosures[0]['href']
+                                   for entry in doc.entries)
                 self.dic = {entry.enclosures[0]['href']: entry
                             for entry in doc.entries}
             except (KeyError, AttributeError):
                 self.outcome = Outcome(False, 'Cant find entries in feed.')
                 # should we set an artificial status here? Or does feedparser?
                 # return
-        from_the_top = sub.find('from_the_top') or 'no'
-        if from_the_top == 'yes':
+        if sub.from_the_top:
             self.lst.reverse()
         try:
             self.image = doc.feed.image['href']
@@ -154,38 +210,54 @@ class Feed:
             self.image = None
 
 
+def parse(body, headers):
+    '''Parse the feed with lxml, leaving anything unusual to feedparser'''
+    return feedxml.parse(body, headers) or \
+        feedparser.parse(body, response_headers=headers)
+
+
 class Combo:
-    '''Constructs a container holding all combined feed and jar
-    entries. Copies feed then adds non-duplicates from jar'''
+    '''All combined feed and jar entries: the feed followed by those only
+       in the jar, or the other way round if going from the top. Uids are
+       produced lazily and feed entries only validated when looked at, so
+       nothing past the last wanted entry is ever touched.'''
     def __init__(self, feed, jar, sub):
-        from_the_top = sub.find('from_the_top') or 'no'
-        if from_the_top == 'yes':
-            self.lst = list(jar.lst)
-            self.lst.extend(uid for uid in feed.lst if uid not in jar.lst)
+        self.feed = feed
+        self.jar = jar
+        self.from_the_top = sub.from_the_top
+
+    def __iter__(self):
+        if self.from_the_top:
+            yield from self.jar.lst
+            yield from (uid for uid in self.feed.lst
+                        if uid not in self.jar.dic)
         else:
-            self.lst = list(feed.lst)
-            self.lst.extend(uid for uid in jar.lst if uid not in feed.lst)
-        self.dic = {uid: entryinfo.validate(feed.dic[uid]) for uid in feed.lst
-                    if uid not in jar.lst}
-        self.dic.update(jar.dic)
+            yield from self.feed.lst
+            yield from (uid for uid in self.jar.lst
+                        if uid not in self.feed.dic)
+
+    def entry(self, uid):
+        if uid in self.jar.dic:
+            return self.jar.dic[uid]
+        entry = self.feed.dic[uid]
+        if 'valid' not in entry:
+            entry = entryinfo.validate(entry)
+        return entry
 
 
 class Wanted():
     '''Filters the combo entries and decides which ones to go for'''
     def __init__(self, sub, feed, combo, del_lst, sub_dir):
         self.outcome = Outcome(True, 'Default true')
-        self.lst = combo.lst
-        self.lst = list(filter(lambda x: x not in del_lst, self.lst))
-        self.lst = list(filter(lambda x: combo.dic[x]['valid'], self.lst))
-        if hasattr(sub, 'filters'):
-            self.apply_filters(sub, combo)
-        if hasattr(sub, 'max_number'):
-            self.limit(sub)
-        self.dic = {uid: entryinfo.expand(combo.dic[uid], sub, sub_dir)
+        del_lst = set(del_lst)
+        candidates = (uid for uid in combo if uid not in del_lst)
+        candidates = (uid for uid in candidates if combo.entry(uid)['valid'])
+        self.select(sub, combo, candidates)
+        self.dic = {uid: entryinfo.expand(combo.entry(uid), sub, sub_dir)
                     for uid in self.lst}
-        filenames = [self.dic[uid]['poca_filename'] for uid in self.lst]
+        filenames = Counter(self.dic[uid]['poca_filename'] for uid in self.lst)
         for uid in self.lst:
-            count = filenames.count(self.dic[uid]['poca_filename'])
+            count = filenames[self.dic[uid]['poca_filename']]
             if count > 1:
                 self.dic[uid]['unique_filename'] = False
             else:
@@ -194,61 +266,92 @@ class Wanted():
         self.feed_modified = feed.modified
         self.feed_image = feed.image
 
-    def match_filename(self, dic, filter_text):
+    def select(self, sub, combo, candidates):
+        '''Apply all filters set to be used on the subscription in a single
+           pass, stopping once max_number episodes have been found'''
+        self.lst = UidList()
+        limit = sub.max_number
+        if sub.filters is not None:
+            filters = get_filters(sub.filters)
+            if isinstance(filters, Outcome):
+                self.outcome = filters
+                return
+        else:
+            filters = None
+        if limit is not None and limit <= 0:
+            return
+        for uid in candidates:
+            entry = combo.entry(uid)
+            try:
+                if filters is not None and not filters(entry):
+                    continue
+            except (KeyError, AttributeError) as e:
+                self.outcome = Outcome(False, 'Entry is missing info: %s' % e)
+                return
+            except (ValueError, TypeError) as e:
+                self.outcome = Outcome(False, 'Bad filter setting: %s' % e)
+                return
+            self.lst.append(uid)
+            if len(self.lst) == limit:
+                break
+
+
+def get_filters(filters):
+    '''Returns the filters compiled into a single test (or the outcome of
+       failing to compile them). They are only compiled once for any set of
+       filter settings.'''
+    if filters not in FILTERS:
+        try:
+            FILTERS[filters] = Filters(filters)
+        except (ValueError, TypeError, re.error) as e:
+            FILTERS[filters] = Outcome(False, 'Bad filter setting: %s' % e)
+    return FILTERS[filters]
+
+
+class Filters:
+    '''A test that an entry passes only if it passes every filter'''
+    def __init__(self, filters):
+        tests = {'after_date': self.after_date,
+                 'filename': self.filename,
+                 'title': self.title,
+                 'hour': self.hour,
+                 'weekdays': self.weekdays}
+        self.tests = [tests[tag](text) for tag, text in filters
+                      if tag in tests]
+
+    def __call__(self, entry):
+        for test in self.tests:
+            if not test(entry):
+                return False
+        return True
+
+    def filename(self, filter_text):
         '''The episode filename must match a regex/string'''
-        # 1.0 entries do not have the 'org_filename' key
-        for x in dic.keys():
-            if not 'org_filename' in dic[x]:
-                dic[x]['org_filename'] = dic[x]['filename']
-        self.lst = [x for x in self.lst if
-                    bool(re.search(filter_text, dic[x]['org_filename']))]
-
-    def match_title(self, dic, filter_text):
+        regex = re.compile(filter_text)
+        def test(entry):
+            # 1.0 entries do not have the 'org_filename' key
+            filename = entry['org_filename'] if 'org_filename' in entry \
+                else entry['filename']
+            return regex.search(filename) is not None
+        return test
+
+    def title(self, filter_text):
         '''The episode title must match a regex/string'''
-        self.lst = [x for x in self.lst if
-                    bool(re.search(filter_text, dic[x]['title']))]
+        regex = re.compile(filter_text)
+        return lambda entry: regex.search(entry['title']) is not None
 
-    def match_weekdays(self, dic, filter_text):
+    def weekdays(self, filter_text):
         '''Only return episodes published on specific week days'''
-        self.lst = [x for x in self.lst if
-                    str(dic[x]['published_parsed'].tm_wday) in
-                    list(filter_text)]
+        weekdays = frozenset(filter_text)
+        return lambda entry: \
+            str(entry['published_parsed'].tm_wday) in weekdays
 
-    def match_date(self, dic, filter_text):
+    def after_date(self, filter_text):
         '''Only return episodes published after a specific date'''
         filter_date = time.strptime(filter_text, '%Y-%m-%d')
-        self.lst = [x for x in self.lst if dic[x]['published_parsed'] >
-                    filter_date]
+        return lambda entry: entry['published_parsed'] > filter_date
 
-    def match_hour(self, dic, filter_text):
+    def hour(self, filter_text):
         '''Only return episodes published at a specific hour of the day'''
-        self.lst = [x for x in self.lst if dic[x]['published_parsed'].tm_hour
-                    == int(filter_text)]
-
-    def apply_filters(self, sub, combo):
-        '''Apply all filters set to be used on the subscription'''
-        func_dic = {'after_date': self.match_date,
-                    'filename': self.match_filename,
-                    'title': self.match_title,
-                    'hour': self.match_hour,
-                    'weekdays': self.match_weekdays}
-        filters = {node.tag for node in sub.filters.iterchildren()}
-        valid_filters = filters & set(func_dic.keys())
-        for key in valid_filters:
-            try:
-                func_dic[key](combo.dic, sub.filters[key].text)
-                self.outcome = Outcome(True, 'Filters applied successfully')
-            except KeyError as e:
-                self.outcome = Outcome(False, 'Entry is missing info: %s' % e)
-            except (ValueError, TypeError, SyntaxError) as e:
-                self.outcome = Outcome(False, 'Bad filter setting: %s' % e)
-
-    def limit(self, sub):
-        '''Limit the number of episodes to that set in max_number'''
-        try:
-            self.lst = self.lst[:int(sub.max_number)]
-            # don't overwrite filter failure
-            if self.outcome.success:
-                self.outcome = Outcome(True, 'Number limited successfully')
-        except ValueError:
-            self.outcome = Outcome(False, 'Bad max_number setting')
+        hour = int(filter_text)
+        return lambda entry: entry['published_parsed'].tm_hour == hour
@@ -8,30 +8,23 @@
 """Operations on feeds with updates"""
 
 
-from threading import Thread, current_thread
-from poca import files, output, tag
-
-
-class SubUpgradeThread(Thread):
-    '''A thread class that creates handles a SubData instance'''
-    def __init__(self, subdata, queue, target):
-        self.subdata = subdata
-        self.queue = queue
-        self.target = target
-        super(SubUpgradeThread, self).__init__()
-
-    def run(self):
-        sub_upgrade = self.target(self.subdata)
-        self.queue.task_done()
+from collections import deque
+from threading import current_thread
+from poca import files, limits, output, tag
+from poca.workers import WorkerPool
 
 
 class SubUpgrade():
     '''Use the SubData packet to implement file operations'''
-    def __init__(self, subdata):
+    def __init__(self, subdata, tag_pool=None):
 
         # know thyself
         self.my_thread = current_thread()
 
+        # files being tagged in other processes, in the order downloaded
+        self.tag_pool = tag_pool
+        self.tagging = deque()
+
         # prepare list for summary
         self.fail_flag = False
         self.removed, self.downed, self.failed = [], [], []
@@ -45,73 +38,151 @@ class SubUpgrade():
             entry = subdata.jar.dic[uid]
             self.remove(uid, entry, subdata)
 
-        for uid in subdata.lacking:
-            entry = subdata.wanted.dic[uid]
-            self.acquire(uid, entry, subdata)
-            if self.outcome.success is None:
-                return
+        # room to leave in mp3 tags for tagging them in place
+        settings = subdata.conf.xml.settings
+        self.padding = tag.padding_needed(subdata.sub,
+                                          int(settings.id3v2version)) \
+            if settings.id3padding == 'yes' else 0
+
+        # bandwidth and connections are shared with other subscriptions
+        self.limiter = limits.Limiter(settings, subdata.sub.limits)
+
+        # downloads may run in parallel but are added to the jar in order
+        jobs = self.start_downloads(subdata)
+        try:
+            for uid in subdata.lacking:
+                entry = subdata.wanted.dic[uid]
+                self.acquire(uid, entry, subdata, jobs.get(uid))
+                if self.outcome.success is None:
+                    return
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            # however the downloads ended, the files queued for tagging
+            # have their track numbers saved
+            self.tagged(subdata)
+
+        # partial downloads are only kept for entries that failed
+        files.delete_stale_parts(subdata.sub_dir, self.failed,
+                                 subdata.conf.xml.settings)
+
+        # download cover image
+        if self.downed and subdata.wanted.feed_image:
+            _outcome = files.download_img_file(subdata.wanted.feed_image,
+                                               subdata.sub_dir,
+                                               subdata.conf.xml.settings)
+            if _outcome.success is False:
+                output.fail_download(subdata.sub.title, _outcome)
 
         # save etag and subsettings after succesful update
         if self.fail_flag is False:
-            subdata.jar.sub = subdata.sub
+            subdata.jar.sub = subdata.sub.xml_string
             subdata.jar.etag = subdata.wanted.feed_etag
             subdata.jar.modified = subdata.wanted.feed_modified
+            subdata.jar.fingerprint = subdata.fingerprint
+        # whatever happened, the directory now matches the jar
+        subdata.jar.dir_mtime = files.dir_mtime(subdata.sub_dir)
         _outcome = subdata.jar.save()
+        if _outcome.success is True:
+            _outcome = subdata.jar.checkpoint()
         if _outcome.success is False:
             output.fail_database(_outcome)
 
-        # download cover image
-        if self.downed and subdata.wanted.feed_image:
-            _outcome = files.download_img_file(subdata.wanted.feed_image,
-                                               subdata.sub_dir,
-                                               subdata.conf.xml.settings)
-            if _outcome.success is False:
-                output.fail_download(subdata.sub.title.text, _outcome)
-
         # print summary of operations in file log
         output.file_summary(subdata, self.removed, self.downed, self.failed)
 
-    def acquire(self, uid, entry, subdata):
+    def start_downloads(self, subdata):
+        '''Start downloading up to parallel_downloads entries at a time.
+           Returns the download jobs by uid (none if downloading serially).'''
+        self.pool = None
+        width = min(subdata.sub.parallel_downloads, len(subdata.lacking))
+        if width < 2:
+            return {}
+        self.pool = WorkerPool(width, maxsize=0)
+        settings = subdata.conf.xml.settings
+        return {uid: self.pool.submit(files.download_file,
+                                      subdata.wanted.dic[uid], settings,
+                                      self.padding, self.limiter)
+                for uid in subdata.lacking}
+
+    def acquire(self, uid, entry, subdata, job=None):
         '''Get new entries, tag them and add to history'''
         output.processing_download(entry)
         wantedindex = subdata.wanted.lst.index(uid) - len(self.failed)
         # see https://github.com/brokkr/poca/wiki/__Developer-notes__
-        self.outcome = files.download_file(entry, subdata.conf.xml.settings)
+        if job is None:
+            self.outcome = files.download_file(entry,
+                                               subdata.conf.xml.settings,
+                                               self.padding, self.limiter)
+        else:
+            self.outcome = job.wait()
+            if job.error is not None:
+                raise job.error
         if self.outcome.success is False:
             entry['filename'], entry['poca_abspath'] = ('', '')
             self.fail_flag = True
             # can prob get title from entry
-            output.fail_download(subdata.sub.title.text, self.outcome)
+            output.fail_download(subdata.sub.title, self.outcome)
             self.failed.append(entry)
             return
         if self.outcome.success is None:
             return
         # some inconsistency in key naming here - needed for backwards compat
         entry['filename'], entry['poca_abspath'] = self.outcome.msg
-        subdata.jar.lst.insert(wantedindex, uid)
-        subdata.jar.dic[uid] = entry
-        _outcome = subdata.jar.save()
+        _outcome = subdata.jar.add(uid, entry, wantedindex)
         if _outcome.success is False:
             self.fail_flag = True
             output.fail_database(_outcome)
         self.downed.append(entry)
+        if self.tag_pool is not None:
+            self.tag(entry, subdata)
+            return
         _outcome = tag.tag_audio_file(subdata.conf.xml.settings,
                                       subdata.sub, subdata.jar, entry)
-        if not _outcome.success:
-            output.fail_tag(subdata.sub.title.text, _outcome)
+        self.report_tag(_outcome, subdata)
+
+    def tag(self, entry, subdata):
+        '''Queue the entry for tagging in the tag pool and move on to the
+           next download. A file to be numbered waits for the files before
+           it to be done, as only they can tell which number is next (a
+           file that could not be tagged or, with 'if missing', already
+           had a number takes none), so that the numbers are those of
+           tagging in place.'''
+        if subdata.sub.track_numbering != 'no':
+            self.tagged(subdata)
+        track_no = getattr(subdata.jar, 'track_no', 0) or 0
+        job = self.tag_pool.submit(entry['poca_abspath'], subdata.sub,
+                                   track_no + 1)
+        self.tagging.append(job)
+
+    def tagged(self, subdata):
+        '''Wait for the files queued for tagging and add the results to
+           the jar in the order the files were downloaded'''
+        while self.tagging:
+            _tagged = self.tag_pool.result(self.tagging.popleft())
+            if _tagged.track_no is not None:
+                _outcome = subdata.jar.set_track_no(_tagged.track_no)
+                if _outcome.success is False:
+                    self.fail_flag = True
+                    output.fail_database(_outcome)
+            self.report_tag(_tagged.outcome, subdata)
+
+    def report_tag(self, outcome, subdata):
+        if not outcome.success:
+            output.fail_tag(subdata.sub.title, outcome)
+        elif outcome.msg != 'Tagging skipped':
+            output.processing_tag(outcome)
 
     def remove(self, uid, entry, subdata):
         '''Deletes the file and removes the entry from the jar'''
         self.outcome = files.delete_file(entry['poca_abspath'])
         if self.outcome.success is False:
             self.fail_flag = True
-            output.fail_delete(subdata.sub.title.text, self.outcome)
+            output.fail_delete(subdata.sub.title, self.outcome)
             return
         output.processing_removal(entry)
         self.removed.append(entry)
-        subdata.jar.lst.remove(uid)
-        del(subdata.jar.dic[uid])
-        _outcome = subdata.jar.save()
+        _outcome = subdata.jar.remove(uid)
         if _outcome.success is False:
             self.fail_flag = True
             output.fail_database(_outcome)
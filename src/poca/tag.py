@@ -7,87 +7,371 @@
 
 """Editing metadata on music files"""
 
-import mutagen
+import os
+from collections import namedtuple
+from fnmatch import fnmatchcase
+from threading import Lock
 
-from mutagen import id3, easyid3, easymp4
+from poca.lazy import LazyModule
 from poca.outcome import Outcome
 
+mutagen = LazyModule('mutagen')
+mp3 = LazyModule('mutagen.mp3')
+mp4 = LazyModule('mutagen.mp4')
+id3 = LazyModule('mutagen.id3')
+easyid3 = LazyModule('mutagen.easyid3')
+easymp4 = LazyModule('mutagen.easymp4')
+# only needed for tag_processes
+multiprocessing = LazyModule('multiprocessing')
+process = LazyModule('concurrent.futures.process')
+
 
-encodings = {3: id3.Encoding.UTF16, 4: id3.Encoding.UTF8}
 id3v1_dic = {'yes': 0, 'no': 2}
 
+Tagged = namedtuple('Tagged', 'outcome track_no')
+
+
 def tag_audio_file(settings, sub, jar, entry):
     '''Metadata tagging using mutagen'''
-    # id3 settings
-    id3v1 = id3v1_dic[settings.id3removev1.text]
-    id3v2 = int(settings.id3v2version)
-    id3encoding = encodings[id3v2]
+    track_no = jar.track_no if hasattr(jar, 'track_no') else 0
+    tagged = tag_file(entry['poca_abspath'], sub,
+                      *id3_settings(settings), track_no + 1)
+    if tagged.track_no is not None:
+        jar.set_track_no(tagged.track_no)
+    return tagged.outcome
+
+
+class TagPool:
+    '''Runs tag_file in worker processes so that tagging does not hold up
+       the threads downloading. The processes are started the first time
+       a file is submitted, so runs with nothing to tag do not pay for
+       them. Jobs are futures; a job whose process died has an outcome
+       of failure.'''
+    def __init__(self, settings, processes):
+        self.id3 = id3_settings(settings)
+        self.processes = processes
+        self.executor = None
+        self.lock = Lock()
+
+    def submit(self, filename, sub, track_no):
+        with self.lock:
+            if self.executor is None:
+                # spawned, as forking a process with threads running is not
+                # safe
+                context = multiprocessing.get_context('spawn')
+                self.executor = process.ProcessPoolExecutor(
+                    self.processes, mp_context=context)
+            return self.executor.submit(tag_file, filename, sub, *self.id3,
+                                        track_no)
+
+    @staticmethod
+    def result(job):
+        '''Wait for a job and return what tag_file returned'''
+        try:
+            return job.result()
+        except (process.BrokenProcessPool, OSError) as e:
+            return Tagged(Outcome(False, 'Tagging failed: %s' % e), None)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=wait)
+
+
+def id3_settings(settings):
+    '''ID3v1 and ID3v2 versions to save mp3 tags as'''
+    return id3v1_dic[settings.id3removev1.text], int(settings.id3v2version)
+
+
+def tag_file(filename, sub, id3v1, id3v2, track_no):
+    '''Tag a file with the metadata of sub, numbering it track_no if
+       track numbering calls for it. Leaves the jar alone so that it can
+       be run in another process: returns the outcome and the track number
+       given the file (None if it was not numbered).'''
+    id3encoding = {3: id3.Encoding.UTF16, 4: id3.Encoding.UTF8}[id3v2]
     # overrides
-    frames = sub.xpath('./metadata/*')
-    overrides = [(override.tag, override.text) for override in frames]
+    overrides = list(sub.metadata)
     key_errors = {}
+    numbered = None
     # track numbering
-    tracks = sub.find('./track_numbering')
-    tracks = tracks.text if tracks else 'no'
+    tracks = sub.track_numbering
     if not overrides and tracks == 'no':
-        return Outcome(True, 'Tagging skipped')
-    # get 'easy' access to metadata
+        return Tagged(Outcome(True, 'Tagging skipped'), None)
+    # the full tags, which the easy keys are set on too (see EasyTags)
     try:
-        audio = mutagen.File(entry['poca_abspath'], easy=True)
+        audio = mutagen.File(filename)
     except mutagen.MutagenError:
-        return Outcome(False, '%s not found or invalid file type for tagging'
-                       % entry['poca_abspath'])
-    except mutagen.mp3.HeaderNotFoundError:
-        return Outcome(False, '%s is a bad mp3' % entry['poca_abspath'])
+        return Tagged(Outcome(False, '%s not found or invalid file type '
+                              'for tagging' % filename), None)
+    except mp3.HeaderNotFoundError:
+        return Tagged(Outcome(False, '%s is a bad mp3' % filename), None)
     if audio is None:
-        return Outcome(False, '%s is invalid file type for tagging' %
-                       entry['poca_abspath'])
-    # add_tags is undocumented for easy but seems to work
+        return Tagged(Outcome(False, '%s is invalid file type for '
+                              'tagging' % filename), None)
     if audio.tags is None:
         audio.add_tags()
+    easy = easy_tags(audio)
+    is_id3 = isinstance(audio, mp3.MP3)
+    if is_id3:
+        convert(audio.tags, id3v2)
+        before = id3_state(audio.tags, *id3_on_disk(filename, audio.tags))
+    else:
+        before = easy_state(audio)
     # tracks
     if tracks == 'yes' or (tracks == 'if missing' and 'tracknumber' not in
-                           audio):
-        track_no = jar.track_no if hasattr(jar, 'track_no') else 0
-        track_no += 1
+                           easy):
         overrides.append(('tracknumber', str(track_no)))
-        jar.track_no = track_no
-        jar.save()
-    # run overrides and save
+        numbered = track_no
+    # run overrides
     while overrides:
         tag, text = overrides.pop()
-        if not text and tag in audio:
-            _text = audio.pop(tag)
+        if not text and tag in easy:
+            _text = easy.pop(tag)
             continue
         try:
-            audio[tag] = text
+            easy[tag] = text
         except (easyid3.EasyID3KeyError, easymp4.EasyMP4KeyError, \
                 ValueError) as e:
             key_errors[tag] = text
-    audio.save()
-    # ONLY for ID3
-    if isinstance(audio, mutagen.mp3.EasyMP3):
-        audio = mutagen.File(entry['poca_abspath'], easy=False)
+    # ONLY for ID3: the rest is done on the frames themselves
+    if is_id3:
+        tags = audio.tags
         if 'comment' in key_errors:
-            audio.tags.delall('COMM')
+            tags.delall('COMM')
             comm_txt = key_errors.pop('comment')
             if comm_txt:
                 comm = id3.COMM(encoding=id3encoding, lang='eng', \
                                 desc='desc', text=comm_txt)
-                audio.tags.add(comm)
+                tags.add(comm)
         if 'chapters' in key_errors:
             _toc = key_errors.pop('chapters')
-            audio.tags.delall('CTOC')
-            audio.tags.delall('CHAP')
-        if id3v2 == 3:
-            audio.tags.update_to_v23()
-        elif id3v2 == 4:
-            audio.tags.update_to_v24()
-        audio.save(v1=id3v1, v2_version=id3v2)
+            tags.delall('CTOC')
+            tags.delall('CHAP')
+        convert(tags, id3v2)
+        # what the file will have after saving
+        after = id3_state(tags, (2, id3v2, 0), id3v1 == 2)
+    else:
+        after = easy_state(audio)
+    # save once, if anything changed
+    if after == before:
+        outcome = Outcome(True, 'Metadata already up to date')
+    else:
+        old_tag = id3v2_size(filename) if is_id3 else None
+        if is_id3:
+            audio.save(v1=id3v1, v2_version=id3v2)
+        else:
+            audio.save()
+        outcome = Outcome(True, 'Metadata updated, %s bytes rewritten' %
+                          rewritten(filename, old_tag, id3v1 == 2))
     # invalid keys
     invalid_keys = list(key_errors.keys())
     if not invalid_keys:
-        return Outcome(True, 'Metadata successfully updated')
+        return Tagged(outcome, numbered)
     else:
-        return Outcome(False, '%s is set to add invalid tags: %s' %
-                       (sub.title.text, ', '.join(invalid_keys)))
+        return Tagged(Outcome(False, '%s is set to add invalid tags: %s' %
+                              (sub.title, ', '.join(invalid_keys))),
+                      numbered)
+
+
+def padding_needed(sub, id3v2):
+    '''Bytes of ID3v2.id3v2 frames that tagging a file with the metadata
+       and track number of sub will add. Each text frame is a 10 byte
+       header, an encoding byte and the text, in UTF-16 with BOM (v2.3) or
+       UTF-8 (v2.4), null terminated. Comments also have a language and
+       description. Frames replacing ones already there are counted in
+       full.'''
+    texts = [(tag, text) for tag, text in sub.metadata if text]
+    if sub.track_numbering != 'no':
+        texts.append(('tracknumber', '9999'))
+    if not texts:
+        return 0
+    def encoded(text):
+        return len(text.encode('utf-16')) + 2 if id3v2 == 3 else \
+            len(text.encode('utf-8')) + 1
+    needed = 0
+    for tag, text in texts:
+        needed += 10 + 1 + encoded(text)
+        if tag == 'comment':
+            needed += len('eng') + encoded('desc')
+    return needed
+
+
+def padded_head(read, padding, id3v2, length):
+    '''Read the start of an mp3 as it is being downloaded (read(n) returns
+       the next n bytes) and make room in its ID3v2 tag for padding more
+       bytes of frames, so that tagging the file later on does not move the
+       audio. If there is no tag, an empty one is put in front of the
+       audio. length is the size of the download if known, from which the
+       spare room that mutagen would leave is worked out. Returns the bytes
+       to write and how many bytes were added to the download. Tags with an
+       extended header (that may state the amount of padding) or a footer,
+       unsynchronised v2.3 tags and v2.2 tags are left as they are.'''
+    head = read(10)
+    if len(head) < 10:
+        return head, 0
+    if head[0] == 0xff and head[1] & 0xe0 == 0xe0 and \
+            head[1] & 0x18 != 0x08 and head[1] & 0x06:
+        # MPEG audio frame (frame sync, valid version and layer): no tag
+        added = 10 + padding + spare(length)
+        return id3_header(id3v2, 0, added - 10) + bytes(added - 10) + head, \
+            added
+    if head[:3] != b'ID3' or head[3] not in (3, 4) or head[5] & 0x50 or \
+            (head[3] == 3 and head[5] & 0x80):
+        return head, 0
+    size = syncsafe(head[6:10])
+    if size is None:
+        return head, 0
+    data = read(size)
+    free = tag_padding(data, head[3]) if len(data) == size else None
+    if free is None or free >= padding:
+        return head + data, 0
+    added = padding - free + spare(length - 10 - size)
+    return id3_header(head[3], head[5], size + added) + data + bytes(added), \
+        added
+
+
+def spare(length):
+    '''Padding mutagen gives a tag it has to make room for (1 KiB plus
+       0.1% of the audio). Much more than that and mutagen would shrink the
+       tag, moving the audio all the same.'''
+    return 1024 + max(length, 0) // 1000
+
+
+def id3_header(version, flags, size):
+    return b'ID3' + bytes((version, 0, flags)) + \
+        bytes((size >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def syncsafe(data):
+    '''The integer stored 7 bits to the byte in data, None if invalid'''
+    if any(byte & 0x80 for byte in data):
+        return None
+    return sum(byte << (7 * no) for no, byte in enumerate(reversed(data)))
+
+
+def tag_padding(data, version):
+    '''Bytes of padding after the frames of the tag data, None if the
+       frames do not add up'''
+    pos = 0
+    while pos + 10 <= len(data) and data[pos] != 0:
+        size = syncsafe(data[pos + 4:pos + 8]) if version == 4 else \
+            int.from_bytes(data[pos + 4:pos + 8], 'big')
+        if size is None:
+            return None
+        pos += 10 + size
+    if pos > len(data) or any(data[pos:]):
+        return None
+    return len(data) - pos
+
+
+class EasyTags:
+    '''The keys of one of mutagen's easy interfaces (easy being EasyID3
+       or EasyMP4Tags) on the full tags of a file, through the handlers
+       the interface registers for them. Frames the easy interface does not
+       know of can then be edited on the same tags without loading the
+       file again.'''
+    def __init__(self, easy, error, tags):
+        self.easy = easy
+        self.error = error
+        self.tags = tags
+
+    def handler(self, kind, key):
+        '''The Get, Set or Delete handler for key, as the easy
+           interface would look it up'''
+        table = getattr(self.easy, kind)
+        key = key.lower()
+        if key in table:
+            return table[key]
+        for pattern, func in table.items():
+            if fnmatchcase(key, pattern):
+                return func
+        func = getattr(self.easy, kind + 'Fallback', None)
+        if func is None:
+            raise self.error('%r is not a valid key' % key)
+        return func
+
+    def __contains__(self, key):
+        try:
+            self.handler('Get', key)(self.tags, key)
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        if isinstance(value, str):
+            value = [value]
+        self.handler('Set', key)(self.tags, key, value)
+
+    def pop(self, key):
+        value = self.handler('Get', key)(self.tags, key)
+        self.handler('Delete', key)(self.tags, key)
+        return value
+
+
+def easy_tags(audio):
+    '''The tags of audio with the keys of the easy interface mutagen has
+       for them (the file itself if it has no other)'''
+    if isinstance(audio.tags, id3.ID3):
+        return EasyTags(easyid3.EasyID3, easyid3.EasyID3KeyError,
+                        audio.tags)
+    if isinstance(audio.tags, mp4.MP4Tags):
+        return EasyTags(easymp4.EasyMP4Tags, easymp4.EasyMP4KeyError,
+                        audio.tags)
+    return audio
+
+
+def convert(tags, id3v2):
+    '''Frames as they are written in ID3v2.id3v2'''
+    if id3v2 == 3:
+        tags.update_to_v23()
+    elif id3v2 == 4:
+        tags.update_to_v24()
+
+
+def id3_state(tags, version, has_v1):
+    '''Everything that saving an ID3 tag writes: frames, ID3v2 version and
+       whether there is an ID3v1 tag. Text encodings are left out as they
+       depend on the version written and not on the text.'''
+    frames = sorted((key, repr(sorted((name, value) for name, value
+                                      in vars(frame).items()
+                                      if name != 'encoding')))
+                    for key, frame in tags.items())
+    return frames, version, has_v1
+
+
+def id3_on_disk(filename, tags):
+    '''ID3v2 version of the tag as loaded (None if there was none) and
+       whether the file has an ID3v1 tag'''
+    version = tags.version if getattr(tags, 'size', 0) else None
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 128, 0))
+        has_v1 = f.read(3) == b'TAG'
+    return version, has_v1
+
+
+def easy_state(audio):
+    return {key: repr(value) for key, value in audio.tags.items()}
+
+
+def id3v2_size(filename):
+    '''Bytes taken up by the ID3v2 tag at the start of the file, header,
+       padding and footer included (0 if there is none)'''
+    with open(filename, 'rb') as f:
+        head = f.read(10)
+    size = syncsafe(head[6:10]) if head[:3] == b'ID3' else None
+    if size is None:
+        return 0
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def rewritten(filename, old_tag, v1):
+    '''Bytes written by saving tags. For ID3 (old_tag being the size of
+       the ID3v2 tag before saving) the audio stays put as long as the
+       ID3v2 tag keeps its size, so only the tags (the ID3v1 one too, if
+       v1) are written; otherwise, as for other formats, the whole file
+       is.'''
+    size = os.path.getsize(filename)
+    if old_tag is not None and id3v2_size(filename) == old_tag:
+        return old_tag + (128 if v1 else 0)
+    return size
@@ -0,0 +1,63 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""An ordered list of entry uids indexed for fast lookups"""
+
+
+class UidList:
+    '''An ordered list of unique uids that is also indexed by uid, so that
+       membership and position lookups take constant time. Adding a uid
+       that is already there does nothing.'''
+    def __init__(self, uids=()):
+        self.uids = []
+        self.positions = {}
+        self.extend(uids)
+
+    def append(self, uid):
+        if uid not in self.positions:
+            self.positions[uid] = len(self.uids)
+            self.uids.append(uid)
+
+    def extend(self, uids):
+        for uid in uids:
+            self.append(uid)
+
+    def index(self, uid):
+        try:
+            return self.positions[uid]
+        except KeyError:
+            raise ValueError('%r is not in list' % uid)
+
+    def reverse(self):
+        self.uids.reverse()
+        self.positions = {uid: index for index, uid in enumerate(self.uids)}
+
+    def filter(self, func):
+        '''Returns a new list of the uids for which func is true'''
+        return UidList(uid for uid in self.uids if func(uid))
+
+    def difference(self, other):
+        '''Returns a new list of the uids not in other, which should be a
+           UidList, set or dict'''
+        return UidList(uid for uid in self.uids if uid not in other)
+
+    def __contains__(self, uid):
+        return uid in self.positions
+
+    def __iter__(self):
+        return iter(self.uids)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return UidList(self.uids[index])
+        return self.uids[index]
+
+    def __repr__(self):
+        return 'UidList(%r)' % self.uids
@@ -0,0 +1,84 @@
+# Copyright 2010-2021 Mads Michelsen (mail@brokkr.net)
+# This file is part of Poca.
+# Poca is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+"""Bounded pools of worker threads"""
+
+from queue import Empty, Queue
+from threading import Event, Thread
+
+
+class Job:
+    '''A unit of work for a worker pool. The callback is called with the
+       job itself once it has finished, successfully or not.'''
+    def __init__(self, func, args, callback=None, stage=None):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.stage = stage
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def wait(self):
+        '''Blocks until the job has finished and returns its result'''
+        self.done.wait()
+        return self.result
+
+
+class WorkerPool:
+    '''A fixed number of worker threads fed by a bounded queue. Submitting
+       blocks when the queue is full.'''
+    def __init__(self, size, maxsize=None):
+        self.size = max(size, 1)
+        maxsize = self.size * 2 if maxsize is None else maxsize
+        self.queue = Queue(maxsize=maxsize)
+        self.threads = []
+        for _ in range(self.size):
+            thread = Thread(target=self.work)
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def submit(self, func, *args, callback=None, stage=None):
+        '''Queue func(*args) for execution and return the job'''
+        job = Job(func, args, callback, stage)
+        self.queue.put(job)
+        return job
+
+    def kill(self):
+        '''Drop queued jobs and flag the workers so that running downloads
+           cancel themselves'''
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        for thread in self.threads:
+            setattr(thread, "kill", True)
+
+    def shutdown(self):
+        '''Let the workers finish the queue and exit'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()